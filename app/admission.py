@@ -0,0 +1,109 @@
+import asyncio
+from collections import deque
+
+from .metrics import ADMISSION_REJECTED
+from .responses import json_response
+
+
+class Saturated(Exception):
+    pass
+
+
+class Lane:
+    # at most limit requests run at once, up to max_queued more wait for at
+    # most queue_timeout seconds in arrival order, any others are rejected
+    def __init__(self, name, limit, max_queued, queue_timeout, retry_after):
+        self.name = name
+        self.limit = limit
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self.waiters) >= self.max_queued:
+            raise Saturated()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Saturated()
+        except BaseException:
+            # the slot was handed over just before the wait was cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        self.admitted += 1
+
+    def release(self):
+        # hands the slot over to the first request still waiting
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'queued': len(self.waiters),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
+
+
+class AdmissionMiddleware:
+    # runs the requests of the export paths in the export lane and all others
+    # in the interactive lane; exports are only queued while no interactive
+    # request is waiting, so interactive traffic goes first when saturated
+    def __init__(self, app, interactive, export, export_paths, exempt_paths=()):
+        self.app = app
+        self.interactive = interactive
+        self.export = export
+        self.export_paths = export_paths
+        self.exempt_paths = exempt_paths
+
+    def lane(self, path):
+        path = path.rstrip("/")
+        if path in self.export_paths:
+            return self.export
+        if path.startswith(self.exempt_paths):
+            return None
+        return self.interactive
+
+    async def __call__(self, scope, receive, send):
+        lane = self.lane(scope["path"]) if scope["type"] == "http" else None
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            if lane is self.export and self.interactive.waiters:
+                raise Saturated()
+            await lane.acquire()
+        except Saturated:
+            lane.rejected += 1
+            ADMISSION_REJECTED.inc(lane.name)
+            response = json_response(
+                status_code=429,
+                content={"error": "Too many requests, try again later"},
+                headers={"Retry-After": str(lane.retry_after)})
+            await response(scope, receive, send)
+            return
+        try:
+            # held until the whole response, streamed or not, has been sent
+            await self.app(scope, receive, send)
+        finally:
+            lane.release()
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+import orjson
+from elasticsearch.exceptions import TransportError
+
+
+logger = logging.getLogger(__name__)
+
+class TTLCache:
+    # size bounded LRU cache whose entries expire after ttl seconds and are
+    # dropped as soon as the version of their index changes
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry_version, expires_at, value = entry
+            if entry_version == version and expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value, version=None):
+        self.entries[key] = (version, time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, index=None):
+        # keys are tuples starting with the index name
+        if index is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key[0] == index]:
+            del self.entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SharedCache:
+    # TTLCache shared by the worker processes of one machine, kept in a sqlite
+    # database that should be on a memory backed file system (e.g. /dev/shm);
+    # values are stored as json, keys are tuples starting with the index name
+    # and the oldest entries are evicted once there are more than maxsize
+    def __init__(self, path, name, maxsize, ttl):
+        self.path = path
+        self.table = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.connection = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _db(self):
+        # opened on first use, so every worker process has its own connection.
+        # The queries run on the event loop, so they never wait for the lock
+        # of another worker: a locked database fails the query, which only
+        # costs a cache miss or a skipped write, and the versions in the keys
+        # make up for a skipped invalidation
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=0,
+                                         isolation_level=None)
+            try:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=OFF")
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                    "key BLOB PRIMARY KEY, idx TEXT, version BLOB, "
+                    "expires_at REAL, value BLOB)")
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self.table}_expires_at "
+                    f"ON {self.table} (expires_at)")
+            except sqlite3.Error:
+                connection.close()
+                raise
+            self.connection = connection
+        return self.connection
+
+    def get(self, key, version=None):
+        try:
+            row = self._db().execute(
+                f"SELECT version, expires_at, value FROM {self.table} "
+                "WHERE key = ?", (orjson.dumps(key),)).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is not None and row[0] == orjson.dumps(version) \
+                and row[1] > time.time():
+            self.hits += 1
+            return orjson.loads(row[2])
+        self.misses += 1
+        return None
+
+    def set(self, key, value, version=None):
+        expires_at = time.time() + self.ttl
+        try:
+            db = self._db()
+            db.execute(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?)",
+                (orjson.dumps(key), key[0], orjson.dumps(version), expires_at,
+                 orjson.dumps(value)))
+            self.writes += 1
+            # evicting on every write would make writes scan the table
+            if self.writes % 64 == 0:
+                self.evict(db)
+        except sqlite3.Error:
+            pass
+
+    def evict(self, db):
+        db.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?",
+                   (time.time(),))
+        db.execute(
+            f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM "
+            f"{self.table} ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,))
+
+    def invalidate(self, index=None):
+        try:
+            if index is None:
+                self._db().execute(f"DELETE FROM {self.table}")
+            else:
+                self._db().execute(f"DELETE FROM {self.table} WHERE idx = ?",
+                                   (index,))
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        try:
+            size = self._db().execute(
+                f"SELECT count(*) FROM {self.table}").fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        lookups = self.hits + self.misses
+        return {
+            'shared': self.path,
+            'size': size,
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class IndexVersions:
+    # cheap per index version token built from the index stats, re-checked at
+    # most once every check_interval seconds; listeners are called with the
+    # index name whenever its version changes. Writes only become searchable
+    # with the next refresh, so the token includes the refresh count and data
+    # read between a write and its refresh gets a version the refresh replaces.
+    # Only the given indexes are versioned, any other name gets None, and
+    # concurrent checks of an index share one stats request
+    def __init__(self, check_interval, indexes):
+        self.check_interval = check_interval
+        self.indexes = indexes
+        self.versions = dict()
+        # wall clock time at which the current version was first seen
+        self.modified = dict()
+        self.listeners = []
+        self.checks = SingleFlight()
+
+    async def get(self, es, index):
+        if index not in self.indexes:
+            return None
+        version, checked_at = self.versions.get(index, (None, 0.0))
+        if time.monotonic() - checked_at < self.check_interval:
+            return version
+        return await self.checks.run(index, lambda: self._check(es, index))
+
+    async def _check(self, es, index):
+        version, _ = self.versions.get(index, (None, 0.0))
+        try:
+            stats = await es.indices.stats(index=index,
+                                           metric="docs,indexing,refresh")
+        except TransportError:
+            # keep serving the last known version if stats are unavailable
+            self.versions[index] = (version, time.monotonic())
+            return version
+        primaries = stats['_all']['primaries']
+        previous_version = version
+        version = (
+            tuple(sorted(stats.get('indices', {}))),
+            primaries['docs']['count'],
+            primaries['indexing']['index_total'],
+            primaries['indexing']['delete_total'],
+            primaries['refresh'].get('external_total',
+                                     primaries['refresh']['total']),
+        )
+        self.versions[index] = (version, time.monotonic())
+        if previous_version != version:
+            self.modified[index] = time.time()
+        if previous_version is not None and previous_version != version:
+            for listener in self.listeners:
+                listener(index)
+        return version
+
+
+class SingleFlight:
+    # concurrent calls with the same key share one in-flight call; the call
+    # runs in its own task so a cancelled caller doesn't fail the others
+    def __init__(self):
+        self.in_flight = dict()
+        self.calls = 0
+        self.collapsed = 0
+
+    async def run(self, key, func):
+        self.calls += 1
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.collapsed += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # marks the exception as retrieved when every caller has gone away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'collapsed': self.collapsed,
+            'in_flight': len(self.in_flight),
+        }
+
+
+class Snapshot:
+    # in-memory copy of a rarely changing result that is served immediately;
+    # once stale it is reloaded in the background while the old copy is
+    # still served, only the very first load is waited for
+    def __init__(self, loader, max_age):
+        self.loader = loader
+        self.max_age = max_age
+        self.value = None
+        self.loaded_at = None
+        self.stale = False
+        self.refreshing = None
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def age(self):
+        if self.loaded_at is None:
+            return None
+        return time.monotonic() - self.loaded_at
+
+    def invalidate(self):
+        self.stale = True
+
+    def needs_refresh(self):
+        return self.loaded_at is None or self.stale or \
+            self.age() > self.max_age
+
+    def refresh(self):
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self._refresh())
+        return self.refreshing
+
+    async def _refresh(self):
+        try:
+            value = await self.loader()
+        except Exception:
+            self.refresh_errors += 1
+            logger.exception("snapshot refresh failed")
+            # without a copy to fall back on the error goes to the caller
+            if self.value is None:
+                raise
+        else:
+            self.value = value
+            self.loaded_at = time.monotonic()
+            self.stale = False
+            self.refreshes += 1
+        finally:
+            self.refreshing = None
+
+    async def get(self):
+        if self.value is None:
+            await asyncio.shield(self.refresh())
+        elif self.needs_refresh():
+            self.refresh()
+        return self.value
+
+    def stats(self):
+        return {
+            'age': self.age(),
+            'max_age': self.max_age,
+            'stale': self.stale,
+            'refreshing': self.refreshing is not None,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+        }
+
+
+def aggregation_cache_key(index, filter=None, phylogeny_filters=None,
+                          search=None, current_class='kingdom'):
+    # filters are combined with AND so their order doesn't change the result
+    filters = tuple(sorted(filter.split(","))) if filter else ()
+    phylogeny = tuple(sorted(phylogeny_filters.split("-"))) \
+        if phylogeny_filters else ()
+    return (index, filters, phylogeny, search or '', current_class)
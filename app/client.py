@@ -0,0 +1,236 @@
+import asyncio
+import os
+import random
+import time
+from typing import NamedTuple
+
+import aiohttp
+from elasticsearch import AsyncElasticsearch, AsyncTransport
+from elasticsearch._async.http_aiohttp import ESClientResponse
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, TransportError
+
+from .metrics import (InstrumentedConnection, InstrumentedJSONSerializer,
+                      ES_ERRORS, ES_REQUEST_RETRIES)
+
+
+ES_HOST = os.getenv('ES_HOST')
+ES_USERNAME = os.getenv('ES_USERNAME')
+ES_PASSWORD = os.getenv('ES_PASSWORD')
+
+# seconds an idle pooled connection is kept open
+ES_KEEPALIVE_TIMEOUT = float(os.getenv('ES_KEEPALIVE_TIMEOUT', '60'))
+# retries of idempotent requests, waiting a random time of up to
+# ES_RETRY_BACKOFF * 2 ** attempt seconds (at most ES_RETRY_MAX_BACKOFF)
+ES_RETRIES = int(os.getenv('ES_RETRIES', '2'))
+ES_RETRY_BACKOFF = float(os.getenv('ES_RETRY_BACKOFF', '0.1'))
+ES_RETRY_MAX_BACKOFF = float(os.getenv('ES_RETRY_MAX_BACKOFF', '2'))
+# consecutive failures that open the circuit, and seconds before a request
+# is let through again to probe the cluster
+ES_BREAKER_THRESHOLD = int(os.getenv('ES_BREAKER_THRESHOLD', '5'))
+ES_BREAKER_RESET_TIMEOUT = float(os.getenv('ES_BREAKER_RESET_TIMEOUT', '10'))
+
+# statuses of overloaded or unreachable clusters
+RETRY_STATUSES = (429, 502, 503, 504)
+# requests that only read, so they can be sent again
+IDEMPOTENT_ENDPOINTS = ("_search", "_msearch", "_mget", "_count")
+
+
+class CallClass(NamedTuple):
+    name: str
+    # seconds before a request is abandoned
+    timeout: float
+    # maximum number of open connections
+    pool_size: int
+    # connections opened on startup
+    warm_connections: int
+
+
+BROWSE = CallClass(
+    'browse',
+    float(os.getenv('ES_BROWSE_TIMEOUT', '30')),
+    int(os.getenv('ES_BROWSE_POOL_SIZE', '20')),
+    int(os.getenv('ES_BROWSE_WARM_CONNECTIONS', '4')))
+EXPORT = CallClass(
+    'export',
+    float(os.getenv('ES_EXPORT_TIMEOUT', '120')),
+    int(os.getenv('ES_EXPORT_POOL_SIZE', '10')),
+    int(os.getenv('ES_EXPORT_WARM_CONNECTIONS', '1')))
+
+
+class CircuitOpen(ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    # opens after threshold consecutive failures, requests then fail
+    # immediately until reset_timeout has passed and a single probe request
+    # succeeds
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            self.rejected += 1
+            return False
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None
+                            and self.failures >= self.threshold):
+            self.opened += 1
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        # the probe ended without an outcome, e.g. it was cancelled
+        self.probing = False
+
+    def stats(self):
+        return {
+            'state': 'closed' if self.opened_at is None else 'open',
+            'failures': self.failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
+
+
+def retryable(exc):
+    # failures of the cluster rather than of the request
+    if isinstance(exc, ConnectionError):
+        return True
+    return exc.status_code in RETRY_STATUSES
+
+
+def idempotent(method, url):
+    if method in ("GET", "HEAD"):
+        return True
+    return url.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1] in IDEMPOTENT_ENDPOINTS
+
+
+class ManagedTransport(AsyncTransport):
+    def __init__(self, hosts, call_class=BROWSE, breaker=None,
+                 retries=ES_RETRIES, **kwargs):
+        # retries are done here with a backoff instead of by the transport
+        kwargs["max_retries"] = 0
+        super().__init__(hosts, **kwargs)
+        self.call_class = call_class
+        self.breaker = breaker
+        self.retries = retries
+
+    async def perform_request(self, method, url, headers=None, params=None,
+                              body=None):
+        perform = super().perform_request
+        return await self.send(method, url, lambda: perform(
+            method, url, headers=headers, params=params, body=body))
+
+    async def perform_raw_request(self, method, url, params=None, body=None,
+                                  headers=None):
+        # like perform_request, but returns the undecoded response body
+        async def perform():
+            await self._async_call()
+            _, _, raw = await self.get_connection().perform_request(
+                method, url, params=params, body=body, headers=headers,
+                timeout=self.call_class.timeout)
+            return raw
+        return await self.send(method, url, perform)
+
+    async def send(self, method, url, perform):
+        retries = self.retries if idempotent(method, url) else 0
+        for attempt in range(retries + 1):
+            try:
+                return await self.attempt(perform)
+            except CircuitOpen:
+                raise
+            except TransportError as exc:
+                # timed out searches are likely to time out again, they
+                # aren't retried so they don't hold up the caller any longer
+                if (attempt == retries or not retryable(exc)
+                        or isinstance(exc, ConnectionTimeout)):
+                    raise
+            ES_REQUEST_RETRIES.inc(self.call_class.name)
+            delay = min(ES_RETRY_MAX_BACKOFF, ES_RETRY_BACKOFF * 2 ** attempt)
+            await asyncio.sleep(random.uniform(0, delay))
+
+    async def attempt(self, perform):
+        breaker = self.breaker
+        if breaker is None:
+            return await perform()
+        if not breaker.allow():
+            ES_ERRORS.inc("circuit_open")
+            raise CircuitOpen("N/A", "Elasticsearch circuit breaker is open")
+        try:
+            result = await perform()
+        except TransportError as exc:
+            if retryable(exc):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        return result
+
+
+class ManagedConnection(InstrumentedConnection):
+    # the aiohttp session of AIOHttpConnection, with a keep-alive timeout
+    async def _create_aiohttp_session(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            skip_auto_headers=("accept", "accept-encoding"),
+            auto_decompress=True,
+            loop=self.loop,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            response_class=ESClientResponse,
+            connector=aiohttp.TCPConnector(
+                limit=self._limit, use_dns_cache=True, ssl=self._ssl_context,
+                keepalive_timeout=ES_KEEPALIVE_TIMEOUT
+            ),
+        )
+
+
+# shared by the clients, which all talk to the same cluster
+breaker = CircuitBreaker(ES_BREAKER_THRESHOLD, ES_BREAKER_RESET_TIMEOUT)
+
+
+def create_client(call_class, hosts=None, **kwargs):
+    if hosts is None:
+        hosts = [ES_HOST]
+        kwargs.setdefault('connection_class', ManagedConnection)
+        kwargs.setdefault('http_auth', (ES_USERNAME, ES_PASSWORD))
+        kwargs.setdefault('use_ssl', True)
+        kwargs.setdefault('verify_certs', True)
+    kwargs.setdefault('serializer', InstrumentedJSONSerializer())
+    kwargs.setdefault('breaker', breaker)
+    return AsyncElasticsearch(
+        hosts,
+        transport_class=ManagedTransport,
+        call_class=call_class,
+        timeout=call_class.timeout,
+        maxsize=call_class.pool_size,
+        **kwargs)
+
+
+async def warm_up(client):
+    # opens the pooled connections concurrently, and does the product check,
+    # before the first request needs them
+    await asyncio.gather(*(client.ping()
+                           for _ in range(client.transport.call_class.warm_connections)))
@@ -7,4 +7,28 @@ DATA_PORTAL_AGGREGATIONS = [
 ARTICLES_AGGREGATIONS = ["pubYear", "journalTitle", "articleType"]
 
 PHYLOGENETIC_RANKS = (
-        'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
\ No newline at end of file
+        'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+
+# every rank that can be filtered on through taxonomies.{rank}
+TAXONOMY_RANKS = frozenset((
+    "kingdom", "phylum", "class", "order", "family", "genus", "species",
+    "cohort", "forma", "infraclass", "infraorder", "parvorder", "section",
+    "series", "species_group", "species_subgroup", "subclass", "subcohort",
+    "subfamily", "subgenus", "subkingdom", "suborder", "subphylum",
+    "subsection", "subspecies", "subtribe", "superclass", "superfamily",
+    "superkingdom", "superorder", "superphylum", "tribe", "varietas"))
+
+# data status filter labels of the downloader and the fields they filter on
+DATA_STATUS_FIELDS = {
+    'Biosamples': 'biosamples',
+    'Raw Data': 'raw_data',
+    'Mapped Reads': 'mapped_reads',
+    'Assemblies': 'assemblies_status',
+    'Annotation Complete': 'annotation_complete',
+    'Annotation': 'annotation_status',
+}
+
+# fields matched by the search parameter
+DATA_PORTAL_SEARCH_FIELDS = ["organism", "commonName",
+                             "symbionts_records.organism.text"]
+ARTICLES_SEARCH_FIELDS = ["title", "journal_name", "study_id", "organism_name"]
@@ -0,0 +1,406 @@
+import asyncio
+import csv
+import heapq
+import io
+import os
+import zlib
+from importlib.util import find_spec
+from typing import NamedTuple
+
+from elasticsearch.exceptions import NotFoundError
+
+from .metrics import EXPORT_BYTES, EXPORT_ROWS
+from .responses import HITS_FILTER_PATH, dumps, search_hits
+
+
+PIT_KEEP_ALIVE = "1m"
+EXPORT_BATCH_SIZE = 1000
+# number of concurrent point in time slices used for an export, 1 disables
+# slicing; each slice buffers at most SLICE_BUFFER_PAGES pages ahead
+EXPORT_SLICES = int(os.getenv('EXPORT_SLICES', '1'))
+MAX_EXPORT_SLICES = 16
+SLICE_BUFFER_PAGES = 2
+
+
+def parse_sort(sort):
+    # converts "field1:asc,field2:desc" into ES body sort clauses
+    clauses = []
+    if not sort:
+        return clauses
+    for sort_item in sort.split(","):
+        field, _, order = sort_item.strip().partition(":")
+        if not field:
+            continue
+        clauses.append({field: {"order": order.strip() or "asc"}})
+    return clauses
+
+
+async def pit_search_pages(es, pit, body, sort=None,
+                           batch_size=EXPORT_BATCH_SIZE, slice_id=None,
+                           slices=None):
+    # pages through every hit of an already opened point in time with
+    # search_after, optionally restricted to one slice of it; pit["id"] is
+    # kept up to date with the id returned by every search, which is the one
+    # the point in time has to be closed with
+    page_body = dict(body)
+    # _shard_doc is the cheapest tie-breaker and keeps search_after stable
+    page_body["sort"] = parse_sort(sort) + [{"_shard_doc": "asc"}]
+    page_body["size"] = batch_size
+    page_body["track_total_hits"] = False
+    if slices and slices > 1:
+        page_body["slice"] = {"id": slice_id, "max": slices}
+    while True:
+        page_body["pit"] = {"id": pit["id"], "keep_alive": PIT_KEEP_ALIVE}
+        response = await es.search(body=page_body,
+                                   filter_path=HITS_FILTER_PATH)
+        pit["id"] = response.get("pit_id", pit["id"])
+        hits = search_hits(response)
+        if not hits:
+            break
+        # taken before the page is handed out, the consumer may drop the
+        # sort values
+        search_after = hits[-1]["sort"]
+        yield hits
+        if len(hits) < batch_size:
+            break
+        page_body["search_after"] = search_after
+
+
+async def close_point_in_time(es, pit_id):
+    try:
+        await es.close_point_in_time(body={"id": pit_id})
+    except NotFoundError:
+        pass
+
+
+async def search_after_pages(es, index, body, sort=None,
+                             batch_size=EXPORT_BATCH_SIZE):
+    # iterates over every hit of the query one page at a time using a
+    # point in time and search_after, so the 10k from_ window doesn't apply
+    pit = await es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)
+    try:
+        async for hits in pit_search_pages(es, pit, body, sort,
+                                           batch_size):
+            yield hits
+    finally:
+        await close_point_in_time(es, pit["id"])
+
+
+class _SortKey:
+    # orders hits by their ES sort values, honouring asc/desc per clause and
+    # putting missing values last like ES does by default
+    __slots__ = ("values", "orders")
+
+    def __init__(self, values, orders):
+        self.values = values
+        self.orders = orders
+
+    def __lt__(self, other):
+        for value, other_value, order in zip(self.values, other.values,
+                                             self.orders):
+            if value == other_value:
+                continue
+            if value is None:
+                return False
+            if other_value is None:
+                return True
+            return value < other_value if order == "asc" else value > other_value
+        return False
+
+
+async def sliced_pages(es, index, body, sort=None, slices=EXPORT_SLICES,
+                       batch_size=EXPORT_BATCH_SIZE):
+    # fetches the slices of one point in time concurrently; when a sort is
+    # given the slices are merged back into a single ordered stream
+    pit = await es.open_point_in_time(index=index, keep_alive=PIT_KEEP_ALIVE)
+    orders = [next(iter(clause.values()))["order"]
+              for clause in parse_sort(sort)]
+    if orders:
+        queues = [asyncio.Queue(maxsize=SLICE_BUFFER_PAGES)
+                  for _ in range(slices)]
+    else:
+        queues = [asyncio.Queue(maxsize=SLICE_BUFFER_PAGES * slices)] * slices
+
+    async def fetch_slice(slice_id):
+        queue = queues[slice_id]
+        try:
+            async for hits in pit_search_pages(es, pit, body, sort,
+                                               batch_size, slice_id, slices):
+                await queue.put(hits)
+        except Exception as exc:
+            await queue.put(exc)
+        else:
+            await queue.put(None)
+
+    tasks = [asyncio.create_task(fetch_slice(slice_id))
+             for slice_id in range(slices)]
+    try:
+        if orders:
+            pages = _merge_ordered(queues, orders + ["asc"], batch_size)
+        else:
+            pages = _merge_unordered(queues[0], slices)
+        async for hits in pages:
+            yield hits
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await close_point_in_time(es, pit["id"])
+
+
+async def _next_page(queue):
+    page = await queue.get()
+    if isinstance(page, Exception):
+        raise page
+    return page
+
+
+async def _merge_unordered(queue, slices):
+    remaining = slices
+    while remaining:
+        hits = await _next_page(queue)
+        if hits is None:
+            remaining -= 1
+            continue
+        yield hits
+
+
+async def _merge_ordered(queues, orders, batch_size):
+    pages = [await _next_page(queue) for queue in queues]
+    positions = [0] * len(queues)
+    heap = [(_SortKey(page[0]["sort"], orders), slice_id)
+            for slice_id, page in enumerate(pages) if page]
+    heapq.heapify(heap)
+    merged = []
+    while heap:
+        _, slice_id = heapq.heappop(heap)
+        merged.append(pages[slice_id][positions[slice_id]])
+        positions[slice_id] += 1
+        if positions[slice_id] == len(pages[slice_id]):
+            pages[slice_id] = await _next_page(queues[slice_id])
+            positions[slice_id] = 0
+        page = pages[slice_id]
+        if page:
+            heapq.heappush(heap, (_SortKey(page[positions[slice_id]]["sort"],
+                                           orders), slice_id))
+        if len(merged) >= batch_size:
+            yield merged
+            merged = []
+    if merged:
+        yield merged
+
+
+async def without_sort(pages):
+    # drops the sort values the hits carry for paging and merging, they aren't
+    # part of the exported records
+    async for hits in pages:
+        for hit in hits:
+            hit.pop("sort", None)
+        yield hits
+
+
+def export_pages(es, index, body, sort=None, slices=EXPORT_SLICES,
+                 batch_size=EXPORT_BATCH_SIZE):
+    slices = max(1, min(slices or 1, MAX_EXPORT_SLICES))
+    if slices > 1:
+        return sliced_pages(es, index, body, sort, slices, batch_size)
+    return search_after_pages(es, index, body, sort, batch_size)
+
+
+class Column(NamedTuple):
+    header: str
+    field: str
+
+
+DATA_PORTAL_METADATA_COLUMNS = (
+    Column('Organism', 'organism'),
+    Column('Common Name', 'commonName'),
+    Column('Common Name Source', 'commonNameSource'),
+    Column('Current Status', 'currentStatus'),
+)
+
+TRACKING_STATUS_METADATA_COLUMNS = (
+    Column('Organism', 'organism'),
+    Column('Common Name', 'commonName'),
+    Column('Metadata submitted to BioSamples', 'biosamples'),
+    Column('Raw data submitted to ENA', 'raw_data'),
+    Column('Mapped reads submitted to ENA', 'mapped_reads'),
+    Column('Assemblies submitted to ENA', 'assemblies_status'),
+    Column('Annotation complete', 'annotation_complete'),
+    Column('Annotation submitted to ENA', 'annotation_status'),
+)
+
+# columns of the exported file per (index_name, downloadOption)
+EXPORT_COLUMNS = {
+    ('data_portal', 'metadata'): DATA_PORTAL_METADATA_COLUMNS,
+    ('data_portal_test', 'metadata'): DATA_PORTAL_METADATA_COLUMNS,
+    ('tracking_status', 'metadata'): TRACKING_STATUS_METADATA_COLUMNS,
+    ('tracking_status_index_test', 'metadata'): TRACKING_STATUS_METADATA_COLUMNS,
+}
+
+
+def export_columns(index_name, download_option):
+    return EXPORT_COLUMNS.get((index_name, download_option.lower()), ())
+
+
+def project_source(body, columns):
+    # only the fields of the exported columns are fetched from ES
+    body = dict(body)
+    body["_source"] = [column.field for column in columns] or False
+    return body
+
+
+# media type and file extension of every export format
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'ndjson.gz': ('application/gzip', 'ndjson.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def export_format_available(export_format):
+    if export_format == 'parquet':
+        return find_spec('pyarrow') is not None
+    return export_format in EXPORT_FORMATS
+
+
+def export_rows(hits, columns):
+    fields = [column.field for column in columns]
+    for entry in hits:
+        record = entry.get("_source", {})
+        yield [record.get(field, '') for field in fields]
+
+
+async def create_data_files_csv(pages, columns):
+    # writes the header and then one chunk of csv rows per page of hits,
+    # only the current page is ever kept in memory
+    output = io.StringIO()
+    csv_writer = csv.writer(output)
+    csv_writer.writerow([column.header for column in columns])
+    async for hits in pages:
+        if columns:
+            csv_writer.writerows(export_rows(hits, columns))
+        yield output.getvalue().encode('utf-8')
+        output.seek(0)
+        output.truncate(0)
+    if output.tell():
+        yield output.getvalue().encode('utf-8')
+
+
+async def create_data_files_ndjson(pages, columns):
+    # one json object per row, keyed on the column headers
+    headers = [column.header for column in columns]
+    async for hits in pages:
+        if not columns:
+            continue
+        yield b"".join(dumps(dict(zip(headers, row))) + b"\n"
+                       for row in export_rows(hits, columns))
+
+
+class _ChunkSink(io.RawIOBase):
+    # write-only file that hands out what was written since the last call,
+    # while still reporting absolute positions to the parquet writer
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def create_data_files_parquet(pages, columns):
+    # every page of hits becomes one row group that is sent as soon as it
+    # is written, the footer follows the last one
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column.header, pa.string()) for column in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        async for hits in pages:
+            rows = list(export_rows(hits, columns))
+            if not rows:
+                continue
+            arrays = [pa.array([None if value is None else str(value)
+                                for value in column_values], pa.string())
+                      for column_values in zip(*rows)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def create_data_file(pages, columns, export_format):
+    if export_format == 'parquet':
+        return create_data_files_parquet(pages, columns)
+    if export_format.startswith('ndjson'):
+        data = create_data_files_ndjson(pages, columns)
+    else:
+        data = create_data_files_csv(pages, columns)
+    if export_format.endswith('.gz'):
+        return gzip_stream(data)
+    return data
+
+
+async def count_rows(pages, export_format):
+    async for hits in pages:
+        EXPORT_ROWS.inc(export_format, amount=len(hits))
+        yield hits
+
+
+async def count_bytes(chunks, export_format):
+    async for chunk in chunks:
+        EXPORT_BYTES.inc(export_format, amount=len(chunk))
+        yield chunk
+
+
+def metered_export(pages, export_format, serialize, *args):
+    # serialize(pages, *args), counting the exported records and bytes
+    return count_bytes(serialize(count_rows(pages, export_format), *args),
+                       export_format)
+
+
+async def stream_ndjson(pages):
+    # serializes the hits one per line, page by page
+    async for hits in pages:
+        if hits:
+            yield b"".join(dumps(hit) + b"\n" for hit in hits)
+
+
+async def stream_json_array(pages):
+    # serializes the hits as one json array, page by page
+    yield b"["
+    first = True
+    async for hits in pages:
+        if not hits:
+            continue
+        chunk = b",".join(dumps(hit) for hit in hits)
+        yield chunk if first else b"," + chunk
+        first = False
+    yield b"]"
@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class ExportJob:
+    def __init__(self, job_id, index, export_format, path):
+        self.id = job_id
+        self.index = index
+        self.format = export_format
+        self.path = path
+        self.status = QUEUED
+        self.error = None
+        self.size = 0
+        self.created_at = time.time()
+        self.finished_at = None
+        # the process that runs the job
+        self.pid = os.getpid()
+
+    def info(self):
+        return {
+            'job_id': self.id,
+            'index': self.index,
+            'format': self.format,
+            'status': self.status,
+            'error': self.error,
+            'size': self.size,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'pid': self.pid,
+        }
+
+    @classmethod
+    def from_info(cls, info, path):
+        job = cls(info['job_id'], info['index'], info['format'], path)
+        job.status = info['status']
+        job.error = info['error']
+        job.size = info['size']
+        job.created_at = info['created_at']
+        job.finished_at = info['finished_at']
+        job.pid = info.get('pid')
+        return job
+
+
+class QueueFull(Exception):
+    pass
+
+
+def process_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ExportJobs:
+    # runs exports in a bounded pool of background workers that write the
+    # result to local files; identical requests share a job and finished files
+    # are reused until they are evicted by age, total size or index change.
+    # The state of every job is also written next to its file, so that the
+    # other worker processes of the service can report and serve it
+    def __init__(self, directory, workers, max_queued, max_bytes, max_age):
+        self.directory = directory
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.jobs = dict()
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.tasks = []
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # the files left over by earlier processes
+        self.evict()
+        self.tasks = [asyncio.create_task(self._worker())
+                      for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # jobs no worker will pick up any more, so they are submitted again
+        while not self.queue.empty():
+            job, _ = self.queue.get_nowait()
+            self._drop(job)
+
+    def submit(self, key, index, export_format, writer):
+        # key identifies the exported data, including the index version
+        job_id = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        job = self.get(job_id)
+        if job is not None and (job.status in (QUEUED, RUNNING) or
+                                (job.status == DONE and os.path.exists(job.path))):
+            return job
+
+        path = os.path.join(self.directory, f"{job_id}.{export_format}")
+        job = ExportJob(job_id, index, export_format, path)
+        try:
+            self.queue.put_nowait((job, writer))
+        except asyncio.QueueFull:
+            raise QueueFull()
+        self.jobs[job_id] = job
+        self._save(job)
+        return job
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None and job.status in (QUEUED, RUNNING):
+            return job
+        # finished jobs can have been evicted by another worker process, and
+        # the jobs of the other worker processes are only known from their
+        # info files
+        job = self._load(job_id)
+        if job is None:
+            self.jobs.pop(job_id, None)
+        return job
+
+    def _job_ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [name[:-5] for name in names if name.endswith('.json')]
+
+    def _info_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, job):
+        info_path = self._info_path(job.id)
+        try:
+            with open(f"{info_path}.{os.getpid()}", 'w') as info_file:
+                json.dump(job.info(), info_file)
+            os.replace(f"{info_path}.{os.getpid()}", info_path)
+        except OSError:
+            # the job is then only known to this process
+            pass
+
+    def _load(self, job_id):
+        # job ids are sha1 hex digests, anything else isn't a file name
+        if len(job_id) != 40 or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self._info_path(job_id)) as info_file:
+                info = json.load(info_file)
+        except (OSError, ValueError):
+            return None
+        path = os.path.join(self.directory, f"{job_id}.{info['format']}")
+        job = ExportJob.from_info(info, path)
+        if job.status in (QUEUED, RUNNING) and (
+                job.pid == os.getpid() or not process_alive(job.pid)):
+            # left over by a process that stopped or crashed, as a job of
+            # this process would be in self.jobs
+            job.status = FAILED
+            job.error = 'interrupted'
+            job.finished_at = job.created_at
+        return job
+
+    async def _worker(self):
+        while True:
+            job, writer = await self.queue.get()
+            job.status = RUNNING
+            self._save(job)
+            # per process, in case another worker runs the same job
+            part_path = f"{job.path}.{os.getpid()}.part"
+            try:
+                with open(part_path, 'wb') as data_file:
+                    async for chunk in writer():
+                        data_file.write(chunk)
+                os.replace(part_path, job.path)
+            except asyncio.CancelledError:
+                job.status = FAILED
+                job.error = 'interrupted'
+                self._remove_file(part_path)
+                raise
+            except Exception as exc:
+                job.status = FAILED
+                job.error = str(exc) or exc.__class__.__name__
+                self._remove_file(part_path)
+            else:
+                job.status = DONE
+                job.size = os.path.getsize(job.path)
+            finally:
+                job.finished_at = time.time()
+                self._save(job)
+                self.queue.task_done()
+                self.evict()
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _drop(self, job):
+        if job.status == DONE:
+            self._remove_file(job.path)
+        self._remove_file(self._info_path(job.id))
+        self.jobs.pop(job.id, None)
+
+    def _finished_jobs(self):
+        # the finished jobs of all processes, from their info files
+        jobs = (self.get(job_id) for job_id in self._job_ids())
+        return [job for job in jobs
+                if job is not None and job.status in (DONE, FAILED)]
+
+    def _remove_orphaned_parts(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith('.part'):
+                continue
+            try:
+                pid = int(name[:-5].rsplit('.', 1)[-1])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not process_alive(pid):
+                self._remove_file(os.path.join(self.directory, name))
+
+    def invalidate(self, index):
+        for job in self._finished_jobs():
+            if job.index == index:
+                self._drop(job)
+
+    def evict(self):
+        try:
+            self._remove_orphaned_parts()
+        except OSError:
+            pass
+        finished = sorted(self._finished_jobs(),
+                          key=lambda job: job.finished_at)
+        now = time.time()
+        total_size = sum(job.size for job in finished)
+        for job in finished:
+            if now - job.finished_at > self.max_age or total_size > self.max_bytes:
+                total_size -= job.size
+                self._drop(job)
+
+    def stats(self):
+        statuses = dict.fromkeys((QUEUED, RUNNING, DONE, FAILED), 0)
+        for job in self.jobs.values():
+            statuses[job.status] += 1
+        return {
+            'jobs': statuses,
+            'queued': self.queue.qsize(),
+            'bytes': sum(job.size for job in self.jobs.values()),
+            'max_bytes': self.max_bytes,
+            'max_age': self.max_age,
+        }
+
+
+def parse_range(range_header, size):
+    # returns the (start, end) byte positions of a single "bytes=" range,
+    # raises ValueError when it can't be satisfied
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in byte_range:
+        raise ValueError(range_header)
+    start, _, end = byte_range.strip().partition("-")
+    if start:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    elif end:
+        # suffix range, the last n bytes
+        start = max(size - int(end), 0)
+        end = size - 1
+    else:
+        raise ValueError(range_header)
+    if start > end or start >= size:
+        raise ValueError(range_header)
+    return start, end
+
+
+def read_file_range(data_file, start, end):
+    # reads from an open file, which is closed at the end
+    with data_file:
+        data_file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = data_file.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -1,16 +1,44 @@
-import csv
+import time
+# start of the import of the app, reported by /ready
+IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import logging
 import os
 import re
-from elasticsearch import AsyncElasticsearch, AIOHttpConnection
-from fastapi import FastAPI, APIRouter
+import tempfile
+from fastapi import FastAPI, APIRouter, Header
 from fastapi.middleware.cors import CORSMiddleware
-import io
 import json
 from pydantic import BaseModel
-from fastapi.responses import StreamingResponse, JSONResponse
-from elasticsearch.exceptions import ConnectionTimeout
-from .constants import DATA_PORTAL_AGGREGATIONS, ARTICLES_AGGREGATIONS, PHYLOGENETIC_RANKS
-
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from elasticsearch.exceptions import ConnectionTimeout, NotFoundError, TransportError
+from .admission import AdmissionMiddleware, Lane
+from .cache import (TTLCache, SharedCache, IndexVersions, SingleFlight,
+                    Snapshot, aggregation_cache_key)
+from .export import (create_data_file, export_columns, export_format_available,
+                     export_pages, gzip_stream, metered_export, count_rows,
+                     project_source, stream_json_array, stream_ndjson,
+                     without_sort, EXPORT_FORMATS, EXPORT_SLICES)
+from .client import create_client, retryable, warm_up, breaker, BROWSE, EXPORT
+from .metrics import (MetricsMiddleware, expose_metrics, measure, EXPORT_BYTES,
+                      METRICS_INDEXES)
+from .jobs import ExportJobs, QueueFull, DONE, parse_range, read_file_range
+from .taxonomy import load_taxonomy_tree
+from .pagination import (search_cursor_page, InvalidCursor, OpenCursors,
+                         TooManyCursors)
+from .query import (build_search_body, build_downloader_body,
+                    compile_typeahead_query, query_cache_stats,
+                    sampled_aggregations, unwrap_sampled_aggregations,
+                    AGGS_EXACT, AGGS_NONE, AGGS_SAMPLED, AGGS_PRECOMPUTED,
+                    AGGS_MODES)
+from .responses import (RawJSONResponse, json_response, dumps, raw_search,
+                        search_hits, search_total, etag, etag_matches,
+                        cache_headers, not_modified, SEARCH_FILTER_PATH,
+                        MSEARCH_FILTER_PATH)
+
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -24,11 +52,107 @@ origins = [
     "*"
 ]
 
-ES_HOST = os.getenv('ES_HOST')
-ES_USERNAME = os.getenv('ES_USERNAME')
-ES_PASSWORD = os.getenv('ES_PASSWORD')
-
-
+# facet aggregations are cached per query, independently of the page
+AGGREGATION_CACHE_SIZE = int(os.getenv('AGGREGATION_CACHE_SIZE', '1024'))
+AGGREGATION_CACHE_TTL = float(os.getenv('AGGREGATION_CACHE_TTL', '300'))
+INDEX_VERSION_CHECK_INTERVAL = float(
+    os.getenv('INDEX_VERSION_CHECK_INTERVAL', '30'))
+# the summary is served from memory and reloaded in the background once older
+SUMMARY_MAX_AGE = float(os.getenv('SUMMARY_MAX_AGE', '300'))
+# records of the details endpoint, cached until their index changes
+DETAILS_CACHE_SIZE = int(os.getenv('DETAILS_CACHE_SIZE', '4096'))
+DETAILS_CACHE_TTL = float(os.getenv('DETAILS_CACHE_TTL', '300'))
+
+# with several uvicorn workers (WEB_CONCURRENCY) the summary, facet and
+# details caches are shared by the workers through a sqlite database, by
+# default in /dev/shm; set SHARED_CACHE_PATH to share them with one worker too
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+SHARED_CACHE_PATH = os.getenv('SHARED_CACHE_PATH', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    'atol-cache.sqlite3') if WEB_CONCURRENCY > 1 else '')
+
+# maximum number of records resolved by one batch details request
+MAX_BATCH_DETAILS = int(os.getenv('MAX_BATCH_DETAILS', '1000'))
+
+# indexes browsed through the in-memory taxonomy tree, which is rebuilt in
+# the background when older than TAXONOMY_TREE_MAX_AGE or its index changes
+TAXONOMY_TREE_INDEXES = [index for index in os.getenv(
+    'TAXONOMY_TREE_INDEXES', 'data_portal').split(',') if index]
+TAXONOMY_TREE_MAX_AGE = float(os.getenv('TAXONOMY_TREE_MAX_AGE', '3600'))
+
+# indexes that have the .ngram search subfields, see app/search_index.py
+NGRAM_SEARCH_INDEXES = [index for index in os.getenv(
+    'NGRAM_SEARCH_INDEXES', '').split(',') if index]
+TYPEAHEAD_MAX_SIZE = 20
+
+# exports run as background jobs are written to EXPORT_JOBS_DIR and kept
+# until they are older than EXPORT_JOBS_MAX_AGE seconds or the files exceed
+# EXPORT_JOBS_MAX_BYTES in total
+EXPORT_JOBS_DIR = os.getenv('EXPORT_JOBS_DIR',
+                            os.path.join(tempfile.gettempdir(), 'atol-exports'))
+EXPORT_JOBS_WORKERS = int(os.getenv('EXPORT_JOBS_WORKERS', '2'))
+EXPORT_JOBS_MAX_QUEUED = int(os.getenv('EXPORT_JOBS_MAX_QUEUED', '100'))
+EXPORT_JOBS_MAX_BYTES = int(os.getenv('EXPORT_JOBS_MAX_BYTES',
+                                      str(2 * 1024 ** 3)))
+EXPORT_JOBS_MAX_AGE = float(os.getenv('EXPORT_JOBS_MAX_AGE', '86400'))
+
+# points in time the cursors of this process may keep open at once, the
+# cluster allows search.max_open_pit_context (300 by default) per node and
+# exports and the taxonomy trees need some of them as well
+CURSOR_MAX_OPEN = int(os.getenv('CURSOR_MAX_OPEN', '100'))
+
+# seconds browsers and CDNs may reuse a response before revalidating it with
+# its ETag, responses can be stale for INDEX_VERSION_CHECK_INTERVAL anyway
+CACHE_CONTROL_MAX_AGE = int(os.getenv('CACHE_CONTROL_MAX_AGE', '30'))
+
+# documents per shard the aggregations of aggs=sampled are computed on
+SAMPLED_AGGS_SHARD_SIZE = int(os.getenv('SAMPLED_AGGS_SHARD_SIZE', '1000'))
+# unfiltered facets served by aggs=precomputed, by index and current class,
+# reloaded in the background when older than PRECOMPUTED_AGGS_MAX_AGE or their
+# index changes; other combinations get exact aggregations
+PRECOMPUTED_AGGS_INDEXES = [index for index in os.getenv(
+    'PRECOMPUTED_AGGS_INDEXES', 'data_portal,tracking_status,articles'
+).split(',') if index]
+PRECOMPUTED_AGGS_CLASSES = [current_class for current_class in os.getenv(
+    'PRECOMPUTED_AGGS_CLASSES', 'kingdom').split(',') if current_class]
+PRECOMPUTED_AGGS_MAX_AGE = float(os.getenv('PRECOMPUTED_AGGS_MAX_AGE', '600'))
+
+# indexes whose unfiltered facets are loaded before the service is ready, and
+# seconds the startup waits for the warm-up before serving anyway
+WARM_UP_FACET_INDEXES = [index for index in os.getenv(
+    'WARM_UP_FACET_INDEXES', 'data_portal').split(',') if index]
+WARM_UP_TIMEOUT = float(os.getenv('WARM_UP_TIMEOUT', '20'))
+
+# number of species sent in a single terms query by the species downloader
+SPECIES_CHUNK_SIZE = 1000
+
+# concurrent requests, queued requests and seconds they may wait, of the
+# interactive requests and of the exports, see app/admission.py
+INTERACTIVE_CONCURRENCY = int(os.getenv('INTERACTIVE_CONCURRENCY', '64'))
+INTERACTIVE_MAX_QUEUED = int(os.getenv('INTERACTIVE_MAX_QUEUED', '256'))
+INTERACTIVE_QUEUE_TIMEOUT = float(os.getenv('INTERACTIVE_QUEUE_TIMEOUT', '5'))
+EXPORT_CONCURRENCY = int(os.getenv('EXPORT_CONCURRENCY', '4'))
+EXPORT_MAX_QUEUED = int(os.getenv('EXPORT_MAX_QUEUED', '8'))
+EXPORT_QUEUE_TIMEOUT = float(os.getenv('EXPORT_QUEUE_TIMEOUT', '30'))
+
+# paths of the requests that page through whole indexes
+EXPORT_PATHS = ("/api/data-download", "/api/downloader_utility_data",
+                "/api/downloader_utility_data_with_species")
+# paths that don't query ES and are always served
+ADMISSION_EXEMPT_PATHS = ("/api/metrics", "/api/cache-stats",
+                          "/api/export-jobs", "/api/ready")
+
+interactive_lane = Lane('interactive', INTERACTIVE_CONCURRENCY,
+                        INTERACTIVE_MAX_QUEUED, INTERACTIVE_QUEUE_TIMEOUT,
+                        retry_after=5)
+export_lane = Lane('export', EXPORT_CONCURRENCY, EXPORT_MAX_QUEUED,
+                   EXPORT_QUEUE_TIMEOUT, retry_after=30)
+
+
+# inside the CORS middleware, so that rejections have the CORS headers too
+app.add_middleware(AdmissionMiddleware, interactive=interactive_lane,
+                   export=export_lane, export_paths=EXPORT_PATHS,
+                   exempt_paths=ADMISSION_EXEMPT_PATHS)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -36,161 +160,396 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-es = AsyncElasticsearch(
-    [ES_HOST],
-    timeout=120,
-    connection_class=AIOHttpConnection,
-    http_auth=(ES_USERNAME, ES_PASSWORD),
-    use_ssl=True, verify_certs=True)
+# outermost, so the timings cover the other middlewares too
+app.add_middleware(MetricsMiddleware)
+
+# separate connection pools and timeouts for the interactive requests and
+# for the exports that page through whole indexes
+es = create_client(BROWSE)
+export_es = create_client(EXPORT)
+
+
+
+def response_cache(name, maxsize, ttl):
+    if SHARED_CACHE_PATH:
+        return SharedCache(SHARED_CACHE_PATH, name, maxsize, ttl)
+    return TTLCache(maxsize, ttl)
+
+
+aggregation_cache = response_cache('aggregations', AGGREGATION_CACHE_SIZE,
+                                   AGGREGATION_CACHE_TTL)
+details_cache = response_cache('details', DETAILS_CACHE_SIZE,
+                               DETAILS_CACHE_TTL)
+# loaded snapshots, so that only one worker loads them from ES; a single
+# worker keeps them in its Snapshot objects only
+shared_snapshots = SharedCache(SHARED_CACHE_PATH, 'snapshots', 64,
+                               SUMMARY_MAX_AGE) if SHARED_CACHE_PATH else None
+open_cursors = OpenCursors(CURSOR_MAX_OPEN)
+# only the indexes the service knows are versioned, so arbitrary /{index}
+# names neither reach the index stats nor grow the versions
+index_versions = IndexVersions(
+    INDEX_VERSION_CHECK_INTERVAL,
+    METRICS_INDEXES.union(TAXONOMY_TREE_INDEXES, PRECOMPUTED_AGGS_INDEXES))
+index_versions.listeners.append(aggregation_cache.invalidate)
+index_versions.listeners.append(details_cache.invalidate)
+single_flight = SingleFlight()
+
+
+async def coalesced_search(**kwargs):
+    # identical concurrent searches are sent to ES once and share the
+    # response, which callers must treat as read only
+    key = json.dumps(kwargs, sort_keys=True, default=str)
+    return await single_flight.run(key, lambda: es.search(**kwargs))
+
+
+async def load_summary():
+    # kept encoded, so serving the summary needs no serialization at all,
+    # with the etag of its content and the time it was loaded
+    hits = None
+    if shared_snapshots is not None:
+        index_version = await index_versions.get(es, "summary")
+        hits = shared_snapshots.get(("summary",), index_version)
+    if hits is None:
+        response = await es.search(index="summary",
+                                    filter_path=SEARCH_FILTER_PATH)
+        hits = search_hits(response)
+        if shared_snapshots is not None:
+            shared_snapshots.set(("summary",), hits, index_version)
+    results = dumps(hits)
+    return results, etag("summary", results), time.time()
+
+
+def taxonomy_tree_loader(index):
+    async def load_tree():
+        return await load_taxonomy_tree(export_es, index)
+    return load_tree
+
+
+async def unfiltered_facets(index, current_class='kingdom'):
+    # the facets of the unfiltered first page, as root() caches them
+    aggregations_key = aggregation_cache_key(index,
+                                             current_class=current_class)
+    index_version = await index_versions.get(es, index)
+    aggregations = aggregation_cache.get(aggregations_key, index_version)
+    if aggregations is None:
+        body = build_search_body(index, current_class=current_class)
+        response = await coalesced_search(index=index, body=body, size=0,
+                                          filter_path="aggregations")
+        aggregations = response['aggregations']
+        aggregation_cache.set(aggregations_key, aggregations, index_version)
+    return aggregations
+
+
+def precomputed_facets_loader(index, current_class):
+    async def load_facets():
+        return await unfiltered_facets(index, current_class)
+    return load_facets
+
+
+summary_snapshot = Snapshot(load_summary, SUMMARY_MAX_AGE)
+taxonomy_trees = {
+    index: Snapshot(taxonomy_tree_loader(index), TAXONOMY_TREE_MAX_AGE)
+    for index in TAXONOMY_TREE_INDEXES
+}
+precomputed_facets = {
+    (index, current_class): Snapshot(
+        precomputed_facets_loader(index, current_class),
+        PRECOMPUTED_AGGS_MAX_AGE)
+    for index in PRECOMPUTED_AGGS_INDEXES
+    for current_class in PRECOMPUTED_AGGS_CLASSES
+}
+# snapshots kept in the background, by the index they are loaded from
+snapshots = {"summary": [summary_snapshot]}
+for index, taxonomy_tree in taxonomy_trees.items():
+    snapshots.setdefault(index, []).append(taxonomy_tree)
+for (index, _), facets in precomputed_facets.items():
+    snapshots.setdefault(index, []).append(facets)
+
+
+def invalidate_snapshots(index):
+    for snapshot in snapshots.get(index, []):
+        snapshot.invalidate()
+
+
+index_versions.listeners.append(invalidate_snapshots)
+export_jobs = ExportJobs(EXPORT_JOBS_DIR, EXPORT_JOBS_WORKERS,
+                         EXPORT_JOBS_MAX_QUEUED, EXPORT_JOBS_MAX_BYTES,
+                         EXPORT_JOBS_MAX_AGE)
+index_versions.listeners.append(export_jobs.invalidate)
+background_tasks = []
+
+
+async def refresh_snapshots_periodically():
+    while True:
+        await asyncio.sleep(INDEX_VERSION_CHECK_INTERVAL)
+        for index, index_snapshots in snapshots.items():
+            # a changed index version invalidates its snapshots; any error is
+            # logged and counted by the snapshot, the loop has to go on
+            try:
+                await index_versions.get(es, index)
+            except Exception:
+                logger.exception("index version check of %s failed", index)
+            for snapshot in index_snapshots:
+                if snapshot.needs_refresh():
+                    try:
+                        await asyncio.shield(snapshot.refresh())
+                    except Exception:
+                        pass
+
+
+async def timed_step(name, step, *args):
+    # failed steps are only reported, their data is loaded by the first
+    # request that needs it instead
+    started = time.perf_counter()
+    try:
+        await step(*args)
+    except Exception as exc:
+        startup_report['errors'][name] = repr(exc)
+    startup_report['steps'][name] = time.perf_counter() - started
+
+
+async def warm_up_service():
+    started = time.perf_counter()
+    # connections first, so that the prefetches don't all open new ones
+    await timed_step('connections', asyncio.gather, warm_up(es),
+                     warm_up(export_es))
+    steps = [timed_step('summary', summary_snapshot.refresh)]
+    for index, taxonomy_tree in taxonomy_trees.items():
+        steps.append(timed_step(f'taxonomy_tree:{index}',
+                                taxonomy_tree.refresh))
+    for index in WARM_UP_FACET_INDEXES:
+        steps.append(timed_step(f'facets:{index}', unfiltered_facets, index))
+    for (index, current_class), facets in precomputed_facets.items():
+        steps.append(timed_step(f'precomputed_facets:{index}:{current_class}',
+                                facets.refresh))
+    await asyncio.gather(*steps)
+    startup_report['warm_up_seconds'] = time.perf_counter() - started
+    startup_report['ready'] = True
+
+
+startup_report = {
+    'ready': False,
+    'import_seconds': None,
+    'warm_up_seconds': None,
+    'steps': dict(),
+    'errors': dict(),
+}
+
+
+@app.on_event("startup")
+async def startup():
+    # a warm-up that takes longer goes on in the background, /ready answers
+    # 503 until it has finished
+    warm_up_task = asyncio.create_task(warm_up_service())
+    background_tasks.append(warm_up_task)
+    try:
+        await asyncio.wait_for(asyncio.shield(warm_up_task), WARM_UP_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    background_tasks.append(
+        asyncio.create_task(refresh_snapshots_periodically()))
+    export_jobs.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await export_jobs.stop()
+    await asyncio.gather(es.close(), export_es.close())
+
+
+@app.exception_handler(TransportError)
+async def elasticsearch_unavailable(request, exc):
+    # unreachable, overloaded or timed out ES, or the circuit breaker is open
+    if isinstance(exc, ConnectionTimeout):
+        return json_response(status_code=504,
+                             content={"error": "Request to Elasticsearch timed out."})
+    if not retryable(exc):
+        raise exc
+    return json_response(status_code=503,
+                         content={"error": "Elasticsearch is unavailable"},
+                         headers={"Retry-After": "10"})
 
 
 @api_router.get("/downloader_utility_data/")
-async def downloader_utility_data(taxonomy_filter: str, data_status: str, experiment_type: str, project_name: str):
-    body = dict()
-    if taxonomy_filter != '':
-
-        if taxonomy_filter:
-            body["query"] = {
-                "bool": {
-                    "filter": list()
-                }
-            }
-
-            nested_queries = []
-            for rank in PHYLOGENETIC_RANKS:
-                nested_query = {
-                    "nested": {
-                        "path": f"taxonomies.{rank}",
-                        "query": {
-                            "bool": {
-                                "filter": [
-                                    {
-                                        "term": {
-                                            f"taxonomies.{rank}.scientificName": taxonomy_filter
-                                        }
-                                    }
-                                ]
-                            }
-                        }
-                    }
-                }
-                nested_queries.append(nested_query)
-            final_query = {
-                "bool": {
-                    "should": nested_queries,
-                    "minimum_should_match": 1  # Adjust depending on your logic
-                }
-            }
+async def downloader_utility_data(taxonomy_filter: str, data_status: str, experiment_type: str, project_name: str,
+                                  slices: int = EXPORT_SLICES, format: str = 'json'):
+    with measure("build"):
+        body = build_downloader_body(taxonomy_filter, data_status,
+                                     experiment_type, project_name)
+    pages = without_sort(export_pages(export_es, "data_portal", body,
+                                      slices=slices, batch_size=10000))
+    if format != 'json':
+        return downloader_response(pages, format)
+    return await collect_json_response(pages)
 
 
-            body["query"]["bool"]["filter"].append(final_query)
+@api_router.get("/downloader_utility_data_with_species/")
+async def downloader_utility_data_with_species(species_list: str, project_name: str,
+                                               stream: bool = False, format: str = 'json'):
+    species = []
+    if species_list != '' and species_list is not None:
+        species = [organism.strip() for organism in species_list.split(",")
+                   if organism.strip()]
+    pages = without_sort(species_pages(species, project_name))
+    if format != 'json':
+        return downloader_response(pages, format)
+    if stream:
+        return StreamingResponse(
+            metered_export(pages, 'json', stream_json_array),
+            media_type='application/json')
+    return await collect_json_response(pages)
 
-    if data_status is not None and data_status != '':
-        split_array = data_status.split("-")
-        if split_array and split_array[0].strip() == 'Biosamples':
-            body["query"]["bool"]["filter"].append(
-                {"term": {'biosamples': split_array[1].strip()}}
-            )
-        elif split_array and split_array[0].strip() == 'Raw Data':
-            body["query"]["bool"]["filter"].append(
-                {"term": {'raw_data': split_array[1].strip()}}
-            )
-        elif split_array and split_array[0].strip() == 'Mapped Reads':
-            body["query"]["bool"]["filter"].append(
-                {"term": {'mapped_reads': split_array[1].strip()}})
-
-        elif split_array and split_array[0].strip() == 'Assemblies':
-            body["query"]["bool"]["filter"].append(
-                {"term": {'assemblies_status': split_array[1].strip()}})
-        elif split_array and split_array[0].strip() == 'Annotation Complete':
-            body["query"]["bool"]["filter"].append(
-                {"term": {'annotation_complete': split_array[1].strip()}})
-        elif split_array and split_array[0].strip() == 'Annotation':
-            body["query"]["bool"]["filter"].append(
-                {"term": {'annotation_status': split_array[1].strip()}})
-        elif split_array and split_array[0].strip() == 'Genome Notes':
-            nested_dict = {
-                "nested": {
-                    "path": "genome_notes",
-                    "query": {
-                        "bool": {
-                            "must": [{
-                                "exists": {
-                                    "field": "genome_notes.url"
-                                }
-                            }]
-                        }
-                    }
-                }
-            }
-            body["query"]["bool"]["filter"].append(nested_dict)
-    if experiment_type != '' and experiment_type is not None:
-        nested_dict = {
-            "nested": {
-                "path": "experiment",
-                "query": {
-                    "bool": {
-                        "must": [{
-                            "term": {
-                                "experiment.library_construction_protocol": experiment_type
-                            }
-                        }]
-                    }
-                }
-            }
-        }
-        body["query"]["bool"]["filter"].append(nested_dict)
-    if project_name is not None and project_name != '':
-        body["query"]["bool"]["filter"].append(
-            {"term": {'project_name': project_name}})
 
-    response = await es.search(index="data_portal", from_=0, size=10000, body=body)
-    total_count = response['hits']['total']['value']
-    result = response['hits']['hits']
-    results_count = len(response['hits']['hits'])
-    while total_count > results_count:
-        response1 = await es.search(index="data_portal", from_=results_count, size=10000, body=body)
-        result.extend(response1['hits']['hits'])
-        results_count += len(response1['hits']['hits'])
+async def collect_json_response(pages):
+    result = []
+    async for hits in count_rows(pages, 'json'):
+        result.extend(hits)
 
-    return result
+    response = json_response(result)
+    EXPORT_BYTES.inc('json', amount=len(response.body))
+    return response
 
 
-@api_router.get("/downloader_utility_data_with_species/")
-async def downloader_utility_data_with_species(species_list: str, project_name: str):
-    body = dict()
-    result = []
-    if species_list != '' and species_list is not None:
-        species_list_array = species_list.split(",")
-        for organism in species_list_array:
-            body = {
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"term": {"project_name": project_name}}
-                        ],
-                        "should": [
-                            {"term": {"_id": organism}},
-                            {"term": {"organism": organism}}
-                        ],
-                        "minimum_should_match": 1
-                    }
+def downloader_response(pages, format):
+    # the downloaders return whole records, so only the record formats apply
+    if format == 'ndjson':
+        return StreamingResponse(metered_export(pages, format, stream_ndjson),
+                                 media_type='application/x-ndjson')
+    if format == 'ndjson.gz':
+        return StreamingResponse(
+            metered_export(pages, format,
+                           lambda chunks: gzip_stream(stream_ndjson(chunks))),
+            media_type='application/gzip')
+    return json_response(status_code=400,
+                         content={"error": f"Unsupported format: {format}"})
+
+
+async def species_pages(species, project_name):
+    # one terms query per chunk of species instead of one search per organism,
+    # a record can match different chunks by _id and organism so chunked
+    # results are de-duplicated
+    seen_ids = set()
+    chunked = len(species) > SPECIES_CHUNK_SIZE
+    for start in range(0, len(species), SPECIES_CHUNK_SIZE):
+        chunk = species[start:start + SPECIES_CHUNK_SIZE]
+        body = {
+            "query": {
+                "bool": {
+                    "must": [
+                        {"term": {"project_name": project_name}}
+                    ],
+                    "should": [
+                        {"terms": {"_id": chunk}},
+                        {"terms": {"organism": chunk}}
+                    ],
+                    "minimum_should_match": 1
                 }
             }
-            response = await es.search(index='data_portal',
-                                       body=body)
-            result.extend(response['hits']['hits'])
+        }
+        async for hits in export_pages(export_es, 'data_portal', body):
+            if chunked:
+                hits = [hit for hit in hits if hit["_id"] not in seen_ids]
+                seen_ids.update(hit["_id"] for hit in hits)
+            yield hits
+
+
+@api_router.get("/cache-stats")
+async def cache_stats():
+    return {'aggregations': aggregation_cache.stats(),
+            'details': details_cache.stats(),
+            'query_bodies': query_cache_stats(),
+            'single_flight': single_flight.stats(),
+            'summary': summary_snapshot.stats(),
+            'export_jobs': export_jobs.stats(),
+            'circuit_breaker': breaker.stats(),
+            'cursors': open_cursors.stats(),
+            'admission': {'interactive': interactive_lane.stats(),
+                          'export': export_lane.stats()},
+            'taxonomy_trees': {index: taxonomy_tree.stats()
+                               for index, taxonomy_tree in taxonomy_trees.items()},
+            'precomputed_facets': {f'{index}:{current_class}': facets.stats()
+                                   for (index, current_class), facets
+                                   in precomputed_facets.items()}}
+
+
+@api_router.get("/ready")
+async def ready():
+    # readiness probe, with the import and warm-up timings of this instance
+    return json_response(startup_report,
+                         status_code=200 if startup_report['ready'] else 503)
+
+
+@api_router.get("/metrics")
+async def metrics():
+    # Prometheus text format, timings are labeled by endpoint and index
+    return PlainTextResponse(expose_metrics(),
+                             media_type="text/plain; version=0.0.4")
+
+
+@api_router.get("/taxonomy-tree/{index}/children")
+async def taxonomy_children(index: str, rank: str | None = None,
+                            name: str | None = None):
+    # children of a taxon, or the top level taxa when no name is given
+    tree = await get_taxonomy_tree(index)
+    if tree is None:
+        return json_response(status_code=404,
+                             content={"error": f"No taxonomy tree for {index}"})
+    node = tree.find(rank, name)
+    if node is None:
+        return json_response(status_code=404,
+                             content={"error": f"Unknown taxon {rank}:{name}"})
+    data = dict()
+    data['taxon'] = node.info()
+    data['results'] = tree.children(rank, name)
+    return json_response(data)
+
+
+@api_router.get("/taxonomy-tree/{index}/lineage")
+async def taxonomy_lineage(index: str, rank: str, name: str):
+    # the taxon and its ancestors, from the top level down
+    tree = await get_taxonomy_tree(index)
+    if tree is None:
+        return json_response(status_code=404,
+                             content={"error": f"No taxonomy tree for {index}"})
+    lineage = tree.lineage(rank, name)
+    if lineage is None:
+        return json_response(status_code=404,
+                             content={"error": f"Unknown taxon {rank}:{name}"})
+    return json_response({'results': lineage})
+
+
+async def get_taxonomy_tree(index):
+    taxonomy_tree = taxonomy_trees.get(index)
+    if taxonomy_tree is None:
+        return None
+    return await taxonomy_tree.get()
+
 
-    return result
+@api_router.get("/typeahead/{index}")
+async def typeahead(index: str, q: str, size: int = 10):
+    # small, aggregation free search for suggestions while typing
+    with measure("build"):
+        body = compile_typeahead_query(index, q,
+                                       ngram=index in NGRAM_SEARCH_INDEXES)
+    response = await coalesced_search(
+        index=index, body=body, size=max(1, min(size, TYPEAHEAD_MAX_SIZE)),
+        filter_path="hits.hits._id,hits.hits._source")
+    return json_response({'results': search_hits(response)})
 
 
 @api_router.get("/summary")
-async def summary():
-    response = await es.search(index="summary")
-    data = dict()
-    data['results'] = response['hits']['hits']
-    return data
+async def summary(if_none_match: str | None = Header(None, alias="If-None-Match")):
+    results, tag, loaded_at = await summary_snapshot.get()
+    headers = cache_headers(tag, loaded_at, CACHE_CONTROL_MAX_AGE)
+    if etag_matches(if_none_match, tag):
+        return not_modified(headers)
+    # seconds since the served summary was loaded from ES
+    snapshot_age = dumps(summary_snapshot.age())
+    return RawJSONResponse(
+        b'{"results":' + results + b',"snapshot_age":' + snapshot_age + b'}',
+        headers=headers)
 
 
 def convert_to_title_case(input_string):
@@ -214,77 +573,147 @@ class QueryParam(BaseModel):
     phylogeny_filters: str
     index_name: str
     downloadOption: str
+    # number of concurrent point in time slices used to fetch the export
+    slices: int = EXPORT_SLICES
+    # one of EXPORT_FORMATS
+    format: str = 'csv'
 
 
 @api_router.post("/data-download")
 async def get_data_files(item: QueryParam):
-
-    data = await fetch_data_in_batches(item)
-
-    if len(data) > 0 :
-        csv_data = create_data_files_csv(data, item.downloadOption,
-                                         item.index_name)
-
-        return StreamingResponse(
-            csv_data,
-            media_type='text/csv',
-            headers={"Content-Disposition": "attachment; filename=download.csv"}
+    if not export_format_available(item.format):
+        return json_response(
+            status_code=400,
+            content={"error": f"Unsupported format: {item.format}"}
         )
-    else:
-        return JSONResponse(
+    columns = export_columns(item.index_name, item.downloadOption)
+    if not columns:
+        return json_response(
+            status_code=400,
+            content={"error": f"Unsupported downloadOption for {item.index_name}: "
+                              f"{item.downloadOption}"}
+        )
+    pages = fetch_data_in_batches(item)
+    # the first page is fetched before responding so that an empty or failed
+    # export can still be reported with a proper status code
+    try:
+        first_page = await anext(pages)
+    except (StopAsyncIteration, ConnectionTimeout):
+        first_page = None
+    if not first_page:
+        return json_response(
             status_code=500,
             content={"error": "There was an issue downloading the file"}
         )
 
+    data_file = metered_export(prepend_page(first_page, pages), item.format,
+                               create_data_file, columns, item.format)
+    media_type, extension = EXPORT_FORMATS[item.format]
+    return StreamingResponse(
+        data_file,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=download.{extension}"}
+    )
+
+
+@api_router.post("/export-jobs", status_code=202)
+async def create_export_job(item: QueryParam):
+    # runs the export of /data-download in the background, identical requests
+    # on the same index version share one job
+    if not export_format_available(item.format):
+        return json_response(
+            status_code=400,
+            content={"error": f"Unsupported format: {item.format}"}
+        )
+    columns = export_columns(item.index_name, item.downloadOption)
+    if not columns:
+        return json_response(
+            status_code=400,
+            content={"error": f"Unsupported downloadOption for {item.index_name}: "
+                              f"{item.downloadOption}"}
+        )
+    index_version = await index_versions.get(es, item.index_name)
+    key = json.dumps([item.dict(exclude={'pageIndex', 'pageSize', 'slices'}),
+                      index_version], sort_keys=True, default=str)
+    try:
+        job = export_jobs.submit(
+            key, item.index_name, item.format,
+            lambda: metered_export(fetch_data_in_batches(item), item.format,
+                                   create_data_file, columns, item.format))
+    except QueueFull:
+        return json_response(
+            status_code=503,
+            content={"error": "Too many export jobs, try again later"},
+            headers={"Retry-After": "60"}
+        )
+    return json_response(job.info(), status_code=202)
+
+
+@api_router.get("/export-jobs/{job_id}")
+async def export_job_status(job_id: str):
+    job = export_jobs.get(job_id)
+    if job is None:
+        return json_response(status_code=404,
+                             content={"error": "Export job not found"})
+    return json_response(job.info())
+
+
+@api_router.get("/export-jobs/{job_id}/download")
+async def download_export_job(job_id: str,
+                              range_header: str | None = Header(None, alias="Range")):
+    job = export_jobs.get(job_id)
+    if job is None:
+        return json_response(status_code=404,
+                             content={"error": "Export job not found"})
+    if job.status != DONE:
+        return json_response(status_code=409, content=job.info())
+    try:
+        # opened before responding, the file can be evicted by another worker
+        # process at any time
+        data_file = open(job.path, 'rb')
+    except FileNotFoundError:
+        return json_response(status_code=404,
+                             content={"error": "Export job not found"})
+
+    media_type, extension = EXPORT_FORMATS[job.format]
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename=download.{extension}",
+    }
+    start, end = 0, job.size - 1
+    status_code = 200
+    if range_header and job.size:
+        try:
+            start, end = parse_range(range_header, job.size)
+        except ValueError:
+            data_file.close()
+            return json_response(
+                status_code=416,
+                content={"error": "Requested range not satisfiable"},
+                headers={"Content-Range": f"bytes */{job.size}"}
+            )
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{job.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(read_file_range(data_file, start, end),
+                             status_code=status_code, media_type=media_type,
+                             headers=headers)
+
 
-def create_data_files_csv(results, download_option, index_name):
-    header = []
-    if download_option.lower() == "metadata" and index_name in ['data_portal', 'data_portal_test']:
-        header = ['Organism', 'Common Name', 'Common Name Source',
-                  'Current Status']
-    elif download_option.lower() == "metadata" and index_name in ['tracking_status', 'tracking_status_index_test']:
-        header = ['Organism', 'Common Name', 'Metadata submitted to BioSamples',
-                  'Raw data submitted to ENA',
-                  'Mapped reads submitted to ENA',
-                  'Assemblies submitted to ENA',
-                  'Annotation complete', 'Annotation submitted to ENA']
-
-    output = io.StringIO()
-    csv_writer = csv.writer(output)
-    csv_writer.writerow(header)
-    for entry in results:
-        record = entry["_source"]
-        if download_option.lower() == "metadata" and index_name in ['data_portal', 'data_portal_test']:
-            organism = record.get('organism', '')
-            common_name = record.get('commonName', '')
-            common_name_source = record.get('commonNameSource', '')
-            current_status = record.get('currentStatus', '')
-            entry = [organism, common_name, common_name_source, current_status]
-            csv_writer.writerow(entry)
-
-        elif download_option.lower() == "metadata" and index_name in ['tracking_status', 'tracking_status_index_test']:
-            organism = record.get('organism', '')
-            common_name = record.get('commonName', '')
-            metadata_biosamples = record.get('biosamples', '')
-            raw_data_ena = record.get('raw_data', '')
-            mapped_reads_ena = record.get('mapped_reads', '')
-            assemblies_ena = record.get('assemblies_status', '')
-            annotation_complete = record.get('annotation_complete', '')
-            annotation_submitted_ena = record.get('annotation_status', '')
-            entry = [organism, common_name, metadata_biosamples, raw_data_ena,
-                     mapped_reads_ena, assemblies_ena,
-                     annotation_complete, annotation_submitted_ena]
-            csv_writer.writerow(entry)
-
-    output.seek(0)
-    return io.BytesIO(output.getvalue().encode('utf-8'))
+async def prepend_page(first_page, pages):
+    yield first_page
+    async for hits in pages:
+        yield hits
 
 
 @api_router.get("/{index}", include_in_schema=True)
 async def root(index: str, offset: int = 0, limit: int = 15,
                sort: str | None = None, filter: str | None = None,
                search: str | None = None, current_class: str = 'kingdom',
-               phylogeny_filters: str | None = None, action: str = None):
+               phylogeny_filters: str | None = None, action: str = None,
+               cursor: str | None = None, raw: bool = False,
+               aggs: str = AGGS_EXACT,
+               if_none_match: str | None = Header(None, alias="If-None-Match")):
     # Skip processing for documentation routes
     if index in ['redoc', 'docs', 'openapi.json']:
         from fastapi.responses import RedirectResponse
@@ -292,295 +721,211 @@ async def root(index: str, offset: int = 0, limit: int = 15,
     # Skip processing for favicon.ico
     if index == 'favicon.ico':
         return None
-
-    # data structure for ES query
-    body = dict()
-    # building aggregations for every request
-    body["aggs"] = dict()
-    if 'articles' in index:
-        aggregations_list = ARTICLES_AGGREGATIONS
-    else:
-        aggregations_list = DATA_PORTAL_AGGREGATIONS
-
-    for aggregation_field in aggregations_list:
-        body["aggs"][aggregation_field] = {
-            "terms": {"field": aggregation_field, "size": 20}
-        }
-        if 'data_portal' in index:
-            body["aggs"]["experiment"] = {
-                "nested": {"path": "experiment"},
-                "aggs": {
-                    "library_construction_protocol": {
-                        "terms": {
-                            "field": "experiment.library_construction_protocol",
-                            "size": 20
-                        },
-                        "aggs": {
-                            "distinct_docs": {
-                                "reverse_nested": {},
-                                # get to the parent document level to count number of docs instead of
-                                # number of terms
-                                "aggs": {
-                                    "parent_doc_count": {
-                                        "cardinality": {
-                                            "field": "tax_id"
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            }
-
-    if 'data_portal' in index or 'tracking_status' in index:
-        body["aggs"]["genome_notes"] = {
-            "nested": {"path": "genome_notes"},
-            "aggs": {
-                "genome_count": {
-                    "reverse_nested": {},  # get to the parent document level
-                    "aggs": {
-                        "distinct_docs": {
-                            "cardinality": {
-                                "field": "id"
-                            }
-                        }
-                    }
-                }
-            }
-        }
-
-        body["aggs"]["taxonomies"] = {
-            "nested": {"path": f"taxonomies.{current_class}"},
-            "aggs": {current_class: {
-                "terms": {
-                    "field": f"taxonomies.{current_class}.scientificName"
-                }
-            }
-            }
-        }
-
-        if phylogeny_filters:
-            body["query"] = {
-                "bool": {
-                    "filter": list()
-                }
-            }
-            phylogeny_filters = phylogeny_filters.split("-")
-            for phylogeny_filter in phylogeny_filters:
-                name, value = phylogeny_filter.split(":")
-                nested_dict = {
-                    "nested": {
-                        "path": f"taxonomies.{name}",
-                        "query": {
-                            "bool": {
-                                "filter": list()
-                            }
-                        }
-                    }
-                }
-                nested_dict["nested"]["query"]["bool"]["filter"].append(
-                    {
-                        "term": {
-                            f"taxonomies.{name}.scientificName": value
-                        }
-                    }
-                )
-                body["query"]["bool"]["filter"].append(nested_dict)
-
-    # adding filters, format: filter_name1:filter_value1, etc...
-    if filter:
-        filters = filter.split(",")
-        if 'query' not in body:
-            body["query"] = {
-                "bool": {
-                    "filter": list()
-                }
-            }
-        for filter_item in filters:
-            if current_class in filter_item:
-                _, value = filter_item.split(":")
-                nested_dict = {
-                    "nested": {
-                        "path": f"taxonomies.{current_class}",
-                        "query": {
-                            "bool": {
-                                "filter": list()
-                            }
-                        }
-                    }
-                }
-                nested_dict["nested"]["query"]["bool"]["filter"].append(
-                    {
-                        "term": {
-                            f"taxonomies.{current_class}.scientificName": value
-                        }
-                    }
-                )
-                body["query"]["bool"]["filter"].append(nested_dict)
-
-            else:
-                filter_name, filter_value = filter_item.split(":")
-
-                # Handle both experimentType and experiment.library_construction_protocol formats
-                if filter_name == 'experimentType' or filter_name == 'experiment.library_construction_protocol':
-                    # If the filter name is experiment.library_construction_protocol, use it directly
-                    # Otherwise, construct the nested path for experimentType
-                    field_path = "experiment.library_construction_protocol"
-                    
-                    nested_dict = {
-                        "nested": {
-                            "path": "experiment",
-                            "query": {
-                                "bool": {
-                                    "filter": {
-                                        "term": {
-                                            field_path: filter_value
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                    body["query"]["bool"]["filter"].append(nested_dict)
-                elif filter_name == 'genome_notes':
-                    nested_dict = {
-                        'nested': {'path': 'genome_notes', 'query': {
-                            'bool': {
-                                'must': [
-                                    {'exists': {
-                                        'field': 'genome_notes.url'}}]}}}}
-                    body["query"]["bool"]["filter"].append(nested_dict)
-                # Handle taxonomy filters (kingdom, phylum, class, etc.)
-                elif filter_name in ["kingdom",
-        "phylum",
-        "class",
-        "order",
-        "family",
-        "genus",
-        "species",
-        "cohort",
-        "forma",
-        "infraclass",
-        "infraorder",
-        "parvorder",
-        "section",
-        "series",
-        "species_group",
-        "species_subgroup",
-        "subclass",
-        "subcohort",
-        "subfamily",
-        "subgenus",
-        "subkingdom",
-        "suborder",
-        "subphylum",
-        "subsection",
-        "subspecies",
-        "subtribe",
-        "superclass",
-        "superfamily",
-        "superkingdom",
-        "superorder",
-        "superphylum",
-        "tribe",
-        "varietas"]:
-                    nested_dict = {
-                        'nested': {'path': f'taxonomies.{filter_name}', 'query': {
-                            'bool': {
-                                'must': [
-                                    {'term': {
-                                        f'taxonomies.{filter_name}.scientificName': filter_value
-                                    }}
-                                ]
-                            }
-                        }}
-                    }
-                    body["query"]["bool"]["filter"].append(nested_dict)
-                else:
-                    body["query"]["bool"]["filter"].append(
-                        {"term": {filter_name: filter_value}})
-
-    # Adding search string
-    if search:
-        if "query" not in body:
-            body["query"] = {"bool": {"must": {"bool": {"should": []}}}}
-        else:
-            body["query"]["bool"].setdefault("must", {"bool": {"should": []}})
-
-        search_fields = (
-            ["title", "journal_name", "study_id", "organism_name"]
-            if 'articles' in index
-            else ["organism", "commonName", "symbionts_records.organism.text"]
-        )
-
-        for field in search_fields:
-            body["query"]["bool"]["must"]["bool"]["should"].append({
-                "wildcard": {
-                    field: {
-                        "value": f"*{search}*",
-                        "case_insensitive": True
-                    }
-                }
-            })
-    
-    if action == 'download':
+    if aggs not in AGGS_MODES:
+        return json_response(status_code=400,
+                             content={"error": f"Unsupported aggs: {aggs}"})
+    if cursor is not None and limit < 1:
+        return json_response(status_code=400,
+                             content={"error": "Cursor pages need a limit of at least 1"})
+    if aggs == AGGS_PRECOMPUTED and \
+            (index, current_class) not in precomputed_facets:
+        aggs = AGGS_EXACT
+
+    aggregations_key = aggregation_cache_key(index, filter, phylogeny_filters,
+                                             search, current_class)
+    index_version = await index_versions.get(es, index)
+    headers = None
+    # pages are identified by the index version and the normalized query, so
+    # a client that already has the page is answered without searching;
+    # cursor pages depend on their point in time and are never revalidated
+    if index_version is not None and cursor is None:
+        tag = etag(index_version, aggregations_key, offset, limit, sort,
+                   action, raw, aggs)
+        headers = cache_headers(tag, index_versions.modified.get(index),
+                                CACHE_CONTROL_MAX_AGE)
+        if etag_matches(if_none_match, tag):
+            return not_modified(headers)
+
+    with measure("build"):
+        body = build_search_body(index, filter, search, current_class,
+                                 phylogeny_filters,
+                                 aggregations=aggs in (AGGS_EXACT, AGGS_SAMPLED),
+                                 ngram=index in NGRAM_SEARCH_INDEXES)
+        if aggs == AGGS_SAMPLED:
+            body["aggs"] = sampled_aggregations(body["aggs"],
+                                                SAMPLED_AGGS_SHARD_SIZE)
+
+    if raw and cursor is None:
+        # the filtered ES response is forwarded without being decoded
+        return RawJSONResponse(await raw_search(
+            es, index, body, sort=sort, size=limit,
+            filter_path=SEARCH_FILTER_PATH, **{"from": offset}),
+            headers=headers)
+
+    # aggregations don't depend on the page, so they are only requested when
+    # they aren't cached for this combination of filters yet; sampled ones
+    # are cached separately, but exact ones are served instead when cached
+    aggregations = None
+    if aggs == AGGS_PRECOMPUTED:
+        aggregations = await precomputed_facets[index, current_class].get()
+    elif aggs != AGGS_NONE:
+        aggregations = aggregation_cache.get(aggregations_key, index_version)
+        if aggregations is None and aggs == AGGS_SAMPLED:
+            aggregations_key += (AGGS_SAMPLED,)
+            aggregations = aggregation_cache.get(aggregations_key,
+                                                 index_version)
+        if aggregations is not None:
+            del body["aggs"]
+
+    next_cursor = None
+    if cursor is not None:
+        # cursor paging, pass "*" for the first page and then the returned
+        # next_cursor instead of offset
+        try:
+            response, next_cursor = await search_cursor_page(
+                es, index, body, sort, limit, cursor, open_cursors)
+        except InvalidCursor:
+            return json_response(status_code=400,
+                                content={"error": "Invalid cursor"})
+        except TooManyCursors:
+            return json_response(
+                status_code=503,
+                content={"error": "Too many open cursors, try again later"},
+                headers={"Retry-After": "60"})
+        except NotFoundError:
+            return json_response(status_code=410,
+                                content={"error": "Cursor has expired"})
+    elif action == 'download':
         try:
-            response = await es.search(index=index, sort=sort, from_=offset,
-                                       body=body, size=limit)
+            response = await coalesced_search(
+                index=index, sort=sort, from_=offset, size=limit, body=body,
+                filter_path=SEARCH_FILTER_PATH)
         except ConnectionTimeout:
             return {"error": "Request to Elasticsearch timed out."}
     else:
-        response = await es.search(index=index, sort=sort, from_=offset,
-                                   size=limit, body=body)
+        response = await coalesced_search(
+            index=index, sort=sort, from_=offset, size=limit, body=body,
+            filter_path=SEARCH_FILTER_PATH)
 
     data = dict()
-    data['count'] = response['hits']['total']['value']
-    data['results'] = response['hits']['hits']
-    data['aggregations'] = response['aggregations']
-    return data
+    data['count'] = search_total(response)
+    data['results'] = search_hits(response)
+    if "aggs" in body:
+        aggregations = response['aggregations']
+        if aggs == AGGS_SAMPLED:
+            aggregations = unwrap_sampled_aggregations(aggregations)
+        aggregation_cache.set(aggregations_key, aggregations, index_version)
+    data['aggregations'] = aggregations if aggregations is not None else {}
+    if aggs != AGGS_EXACT:
+        data['aggs'] = aggs
+    if cursor is not None:
+        data['next_cursor'] = next_cursor
+    return json_response(data, headers=headers)
 
 
 @api_router.get("/{index}/{record_id}")
-async def details(index: str, record_id: str):
-    body = dict()
-    response = await es.search(index=index, q=f"_id:{record_id}")
-    if len(response['hits']['hits']) == 0:
-        body["query"] = {
-            "bool": {"filter": [{'term': {'organism': record_id}}]}}
-        response = await es.search(index=index, body=body)
+async def details(index: str, record_id: str,
+                  if_none_match: str | None = Header(None, alias="If-None-Match")):
+    index_version = await index_versions.get(es, index)
+    headers = None
+    if index_version is not None:
+        tag = etag(index, index_version, record_id)
+        headers = cache_headers(tag, index_versions.modified.get(index),
+                                CACHE_CONTROL_MAX_AGE)
+        if etag_matches(if_none_match, tag):
+            return not_modified(headers)
+    data = details_cache.get((index, record_id), index_version)
+    if data is None:
+        data = await load_details(index, record_id)
+        details_cache.set((index, record_id), data, index_version)
+    return json_response(data, headers=headers)
+
+
+async def load_details(index, record_id):
+    # realtime get by id, records that aren't found are looked up by organism
+    try:
+        record = await es.get(index=index, id=record_id,
+                              filter_path="_id,_source")
+    except NotFoundError:
+        record = None
+    if record is not None:
+        data = dict()
+        data['count'] = 1
+        data['results'] = [record_as_hit(record)]
+        return data
+
+    response = await es.search(index=index, body=organism_body(record_id),
+                               filter_path=SEARCH_FILTER_PATH)
     data = dict()
-    data['count'] = response['hits']['total']['value']
-    data['results'] = response['hits']['hits']
+    data['count'] = search_total(response)
+    data['results'] = search_hits(response)
     return data
 
 
+class RecordIds(BaseModel):
+    ids: list[str]
 
-async def fetch_data_in_batches(item: QueryParam):
-    offset = 0
-    batch_size = 1000
-    all_data = []
 
-    while True:
-
-        data = await root(
-            item.index_name, offset, batch_size,
-            item.sortValue, item.filterValue,
-            item.searchValue, item.currentClass,
-            item.phylogeny_filters, 'download'
+@api_router.post("/{index}/details")
+async def batch_details(index: str, item: RecordIds):
+    # resolves many records with one mget, ids that aren't found are looked up
+    # by organism with a single msearch
+    if len(item.ids) > MAX_BATCH_DETAILS:
+        return json_response(
+            status_code=400,
+            content={"error": f"At most {MAX_BATCH_DETAILS} ids per request"}
         )
+    data = dict()
+    if not item.ids:
+        return json_response(data)
+    response = await es.mget(index=index, body={"ids": item.ids},
+                             filter_path="docs._id,docs.found,docs._source")
+    missing = []
+    for record in response['docs']:
+        if record.get('found'):
+            data[record['_id']] = {'count': 1,
+                                   'results': [record_as_hit(record)]}
+        else:
+            missing.append(record['_id'])
+
+    if missing:
+        searches = []
+        for organism in missing:
+            searches.append({})
+            searches.append(organism_body(organism))
+        response = await es.msearch(index=index, body=searches,
+                                    filter_path=MSEARCH_FILTER_PATH)
+        for organism, result in zip(missing, response['responses']):
+            if 'error' in result:
+                data[organism] = {'count': 0, 'results': []}
+                continue
+            data[organism] = {'count': search_total(result),
+                              'results': search_hits(result)}
+    return json_response(data)
+
 
+def organism_body(organism):
+    return {"query": {"bool": {"filter": [{'term': {'organism': organism}}]}}}
 
-        results = data.get('results', [])
-        if not results:
-            break
 
-        all_data.extend(results)
-        offset += batch_size
-        print(f"Fetched {len(results)} results, total: {len(all_data)}")
+def record_as_hit(record):
+    # shapes a get/mget document like a search hit
+    return {key: record[key] for key in ('_id', '_source') if key in record}
 
-    return all_data
+
+def fetch_data_in_batches(item: QueryParam):
+    with measure("build"):
+        body = build_search_body(item.index_name, item.filterValue,
+                                 item.searchValue, item.currentClass,
+                                 item.phylogeny_filters, aggregations=False,
+                                 ngram=item.index_name in NGRAM_SEARCH_INDEXES)
+        body = project_source(body, export_columns(item.index_name,
+                                                   item.downloadOption))
+    return export_pages(export_es, item.index_name, body, item.sortValue,
+                        item.slices)
 
 
 # Include the API router in the main app
-app.include_router(api_router)
\ No newline at end of file
+app.include_router(api_router)
+
+startup_report['import_seconds'] = time.perf_counter() - IMPORT_STARTED
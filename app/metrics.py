@@ -0,0 +1,203 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from elasticsearch import AIOHttpConnection
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# index label values, any other index is reported as "other" so that
+# arbitrary /{index} paths can't create new time series
+METRICS_INDEXES = frozenset(os.getenv(
+    'METRICS_INDEXES',
+    'data_portal,data_portal_test,tracking_status,tracking_status_index_test,'
+    'articles,summary').split(','))
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = dict()
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = dict()
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[position] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",),
+                                       label_values + (repr(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+REQUESTS = Counter("api_requests_total", "HTTP requests by endpoint, index and status",
+                   ("endpoint", "index", "status"))
+REQUEST_DURATION = Histogram("api_request_duration_seconds",
+                             "Time until the whole response was sent",
+                             ("endpoint", "index"))
+# phases: build (ES body construction), es (ES round-trips), es_took (time
+# reported by ES), decode (ES response json decoding), serialize (response
+# encoding)
+REQUEST_PHASE = Histogram("api_request_phase_seconds",
+                          "Time spent per request in each phase",
+                          ("endpoint", "index", "phase"))
+ES_ERRORS = Counter("api_es_errors_total", "Failed ES requests by error",
+                    ("error",))
+ES_REQUEST_RETRIES = Counter("api_es_retries_total",
+                             "ES requests sent again by client",
+                             ("client",))
+ADMISSION_REJECTED = Counter("api_admission_rejected_total",
+                             "Requests rejected with 429 by lane", ("lane",))
+EXPORT_ROWS = Counter("api_export_rows_total", "Records written by exports",
+                      ("format",))
+EXPORT_BYTES = Counter("api_export_bytes_total", "Bytes written by exports",
+                       ("format",))
+
+METRICS = (REQUESTS, REQUEST_DURATION, REQUEST_PHASE, ES_ERRORS,
+           ES_REQUEST_RETRIES, ADMISSION_REJECTED, EXPORT_ROWS, EXPORT_BYTES)
+
+
+def expose_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+# phase durations of the current request, shared with the tasks it starts
+request_phases = ContextVar("request_phases", default=None)
+
+
+def add_phase(phase, seconds):
+    phases = request_phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def measure(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    # ASGI middleware timing every request until its last body chunk is sent
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        phases = dict()
+        token = request_phases.set(phases)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_phases.reset(token)
+            endpoint = scope.get("endpoint")
+            endpoint = getattr(endpoint, "__name__", "unknown")
+            index = scope.get("path_params", {}).get("index", "")
+            if index and index not in METRICS_INDEXES:
+                index = "other"
+            REQUESTS.inc(endpoint, index, status)
+            REQUEST_DURATION.observe(time.perf_counter() - started, endpoint, index)
+            for phase, seconds in phases.items():
+                REQUEST_PHASE.observe(seconds, endpoint, index, phase)
+
+
+class InstrumentedJSONSerializer(JSONSerializer):
+    # times the decoding of ES responses and collects the took they report
+    def loads(self, s):
+        started = time.perf_counter()
+        data = super().loads(s)
+        add_phase("decode", time.perf_counter() - started)
+        if isinstance(data, dict) and "took" in data:
+            add_phase("es_took", data["took"] / 1000)
+        return data
+
+
+class InstrumentedConnection(AIOHttpConnection):
+    # times ES round-trips and counts the failed ones
+    async def perform_request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().perform_request(*args, **kwargs)
+        except ConnectionTimeout:
+            ES_ERRORS.inc("timeout")
+            raise
+        except ConnectionError:
+            ES_ERRORS.inc("connection")
+            raise
+        except TransportError as exc:
+            ES_ERRORS.inc(str(exc.status_code))
+            raise
+        finally:
+            add_phase("es", time.perf_counter() - started)
@@ -0,0 +1,132 @@
+import base64
+import binascii
+import hashlib
+import json
+import time
+
+from .export import close_point_in_time, parse_sort
+from .responses import SEARCH_FILTER_PATH, search_hits
+
+
+# cursor value a client sends to start paging through a query
+FIRST_CURSOR = "*"
+# seconds a cursor's point in time is kept open after its last page, every
+# page renews it
+CURSOR_KEEP_ALIVE_SECONDS = 60
+CURSOR_KEEP_ALIVE = f"{CURSOR_KEEP_ALIVE_SECONDS}s"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class TooManyCursors(Exception):
+    pass
+
+
+class OpenCursors:
+    # the points in time of the cursors of this process that haven't expired
+    # yet; the cluster limits open points in time per node and exports need
+    # them too, so new cursors are refused once limit of them are open
+    def __init__(self, limit, keep_alive=CURSOR_KEEP_ALIVE_SECONDS):
+        self.limit = limit
+        self.keep_alive = keep_alive
+        self.expires_at = dict()
+        self.refused = 0
+
+    def expire(self):
+        now = time.monotonic()
+        for pit_id in [pit_id for pit_id, expires_at in self.expires_at.items()
+                       if expires_at <= now]:
+            del self.expires_at[pit_id]
+
+    def reserve(self):
+        self.expire()
+        if len(self.expires_at) >= self.limit:
+            self.refused += 1
+            raise TooManyCursors()
+
+    def renew(self, previous_pit_id, pit_id):
+        self.expires_at.pop(previous_pit_id, None)
+        self.expires_at[pit_id] = time.monotonic() + self.keep_alive
+
+    def close(self, pit_id):
+        self.expires_at.pop(pit_id, None)
+
+    def stats(self):
+        self.expire()
+        return {
+            'open': len(self.expires_at),
+            'limit': self.limit,
+            'refused': self.refused,
+        }
+
+
+def encode_cursor(state):
+    data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        state = json.loads(data)
+    except (binascii.Error, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(state, dict) or not {'pit', 'after', 'query'} <= state.keys():
+        raise InvalidCursor(cursor)
+    return state
+
+
+def query_fingerprint(index, body, sort):
+    # ties a cursor to the query it was created for
+    data = json.dumps([index, body.get("query"), sort or ''], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+async def search_cursor_page(es, index, body, sort, size, cursor,
+                             open_cursors):
+    # returns one page of hits after the cursor and the cursor of the next
+    # page, which is None once the query is exhausted; every page is a
+    # search_after on a point in time so deep pages cost the same as the first
+    fingerprint = query_fingerprint(index, body, sort)
+    if cursor == FIRST_CURSOR:
+        open_cursors.reserve()
+        pit = await es.open_point_in_time(index=index,
+                                          keep_alive=CURSOR_KEEP_ALIVE)
+        pit_id = pit["id"]
+        open_cursors.renew(None, pit_id)
+        search_after = None
+    else:
+        state = decode_cursor(cursor)
+        if state['query'] != fingerprint:
+            raise InvalidCursor(cursor)
+        pit_id = state['pit']
+        search_after = state['after']
+
+    page_body = dict(body)
+    page_body["sort"] = parse_sort(sort) + [{"_shard_doc": "asc"}]
+    page_body["size"] = size
+    page_body["pit"] = {"id": pit_id, "keep_alive": CURSOR_KEEP_ALIVE}
+    if search_after is not None:
+        page_body["search_after"] = search_after
+    try:
+        response = await es.search(body=page_body,
+                                   filter_path=SEARCH_FILTER_PATH)
+    except Exception:
+        # nobody has a cursor for the point in time opened by this request
+        if cursor == FIRST_CURSOR:
+            open_cursors.close(pit_id)
+            await close_point_in_time(es, pit_id)
+        raise
+    previous_pit_id, pit_id = pit_id, response.get("pit_id", pit_id)
+    open_cursors.renew(previous_pit_id, pit_id)
+
+    hits = search_hits(response)
+    if not hits or len(hits) < size:
+        open_cursors.close(pit_id)
+        await close_point_in_time(es, pit_id)
+        return response, None
+    next_cursor = encode_cursor({'pit': pit_id, 'after': hits[-1]["sort"],
+                                 'query': fingerprint})
+    return response, next_cursor
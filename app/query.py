@@ -0,0 +1,393 @@
+import os
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+from .constants import (DATA_PORTAL_AGGREGATIONS, ARTICLES_AGGREGATIONS,
+                        PHYLOGENETIC_RANKS, TAXONOMY_RANKS,
+                        DATA_STATUS_FIELDS, DATA_PORTAL_SEARCH_FIELDS,
+                        ARTICLES_SEARCH_FIELDS)
+
+
+# number of compiled ES bodies kept for identical request parameters
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', '2048'))
+
+# length of the n-grams indexed in the .ngram search subfields, search
+# strings without a word of at least that length fall back to wildcard
+# queries
+NGRAM_SIZE = 3
+# the words the n-gram tokenizer splits text into, runs of letters and digits
+NGRAM_TOKEN = re.compile(r"[^\W_]+")
+
+
+# facet modes of the /{index} aggs parameter: exact aggregations of the
+# query, no aggregations, aggregations of a sample of the best matching
+# documents of every shard, or the unfiltered aggregations materialized in the
+# background
+AGGS_EXACT = 'exact'
+AGGS_NONE = 'none'
+AGGS_SAMPLED = 'sampled'
+AGGS_PRECOMPUTED = 'precomputed'
+AGGS_MODES = (AGGS_EXACT, AGGS_NONE, AGGS_SAMPLED, AGGS_PRECOMPUTED)
+
+
+# filter kinds of the /{index} filter parameter
+CURRENT_CLASS = 'current_class'
+EXPERIMENT = 'experiment'
+GENOME_NOTES = 'genome_notes'
+TAXONOMY = 'taxonomy'
+TERM = 'term'
+
+
+class Filter(NamedTuple):
+    kind: str
+    name: str
+    value: str
+
+
+class SearchQuery(NamedTuple):
+    index: str
+    current_class: str
+    phylogeny: tuple
+    filters: tuple
+    search: str | None
+    aggregations: bool
+    ngram: bool
+
+
+class DownloaderQuery(NamedTuple):
+    taxonomy_filter: str | None
+    data_status: tuple | None
+    experiment_type: str | None
+    project_name: str | None
+
+
+def parse_search_query(index, filter=None, search=None,
+                       current_class='kingdom', phylogeny_filters=None,
+                       aggregations=True, ngram=False):
+    phylogeny = ()
+    # phylogeny filters only apply to the indexes with taxonomies,
+    # format: rank1:name1-rank2:name2
+    if phylogeny_filters and ('data_portal' in index or 'tracking_status' in index):
+        phylogeny = tuple(tuple(phylogeny_filter.split(":"))
+                          for phylogeny_filter in phylogeny_filters.split("-"))
+        for phylogeny_filter in phylogeny:
+            if len(phylogeny_filter) != 2:
+                raise ValueError(f"Invalid phylogeny filter: {phylogeny_filters}")
+
+    # format: filter_name1:filter_value1,filter_name2:filter_value2
+    filters = []
+    if filter:
+        for filter_item in filter.split(","):
+            filter_name, filter_value = filter_item.split(":")
+            if current_class in filter_item:
+                filters.append(Filter(CURRENT_CLASS, current_class,
+                                      filter_value))
+            # Handle both experimentType and experiment.library_construction_protocol formats
+            elif filter_name in ('experimentType', 'experiment.library_construction_protocol'):
+                filters.append(Filter(EXPERIMENT, filter_name, filter_value))
+            elif filter_name == 'genome_notes':
+                filters.append(Filter(GENOME_NOTES, filter_name, filter_value))
+            elif filter_name in TAXONOMY_RANKS:
+                filters.append(Filter(TAXONOMY, filter_name, filter_value))
+            else:
+                filters.append(Filter(TERM, filter_name, filter_value))
+
+    return SearchQuery(index, current_class, phylogeny, tuple(filters),
+                       search or None, aggregations, ngram)
+
+
+def parse_downloader_query(taxonomy_filter=None, data_status=None,
+                           experiment_type=None, project_name=None):
+    status = None
+    # format: "Label - value", see DATA_STATUS_FIELDS for the labels
+    if data_status:
+        split_array = data_status.split("-")
+        label = split_array[0].strip()
+        if label == 'Genome Notes':
+            status = (GENOME_NOTES, None)
+        elif label in DATA_STATUS_FIELDS:
+            status = (DATA_STATUS_FIELDS[label], split_array[1].strip())
+    return DownloaderQuery(taxonomy_filter or None, status,
+                           experiment_type or None, project_name or None)
+
+
+def _nested_term(path, field, value, clause="filter"):
+    return {
+        "nested": {
+            "path": path,
+            "query": {
+                "bool": {
+                    clause: [{"term": {field: value}}]
+                }
+            }
+        }
+    }
+
+
+def _genome_notes_exists():
+    return {
+        "nested": {
+            "path": "genome_notes",
+            "query": {
+                "bool": {
+                    "must": [{"exists": {"field": "genome_notes.url"}}]
+                }
+            }
+        }
+    }
+
+
+def _experiment_term(value, clause="filter"):
+    term = {"term": {"experiment.library_construction_protocol": value}}
+    return {
+        "nested": {
+            "path": "experiment",
+            "query": {
+                "bool": {
+                    # the browse filter uses a single clause, the downloader a list
+                    clause: term if clause == "filter" else [term]
+                }
+            }
+        }
+    }
+
+
+def compile_aggregations(index, current_class):
+    aggs = dict()
+    if 'articles' in index:
+        aggregations_list = ARTICLES_AGGREGATIONS
+    else:
+        aggregations_list = DATA_PORTAL_AGGREGATIONS
+
+    for aggregation_field in aggregations_list:
+        aggs[aggregation_field] = {
+            "terms": {"field": aggregation_field, "size": 20}
+        }
+    if 'data_portal' in index:
+        aggs["experiment"] = {
+            "nested": {"path": "experiment"},
+            "aggs": {
+                "library_construction_protocol": {
+                    "terms": {
+                        "field": "experiment.library_construction_protocol",
+                        "size": 20
+                    },
+                    "aggs": {
+                        "distinct_docs": {
+                            "reverse_nested": {},
+                            # get to the parent document level to count number of docs instead of
+                            # number of terms
+                            "aggs": {
+                                "parent_doc_count": {
+                                    "cardinality": {
+                                        "field": "tax_id"
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+    if 'data_portal' in index or 'tracking_status' in index:
+        aggs["genome_notes"] = {
+            "nested": {"path": "genome_notes"},
+            "aggs": {
+                "genome_count": {
+                    "reverse_nested": {},  # get to the parent document level
+                    "aggs": {
+                        "distinct_docs": {
+                            "cardinality": {
+                                "field": "id"
+                            }
+                        }
+                    }
+                }
+            }
+        }
+
+        aggs["taxonomies"] = {
+            "nested": {"path": f"taxonomies.{current_class}"},
+            "aggs": {current_class: {
+                "terms": {
+                    "field": f"taxonomies.{current_class}.scientificName"
+                }
+            }
+            }
+        }
+    return aggs
+
+
+def sampled_aggregations(aggs, shard_size):
+    return {"sample": {"sampler": {"shard_size": shard_size}, "aggs": aggs}}
+
+
+def unwrap_sampled_aggregations(aggregations):
+    # the sub-aggregations of the sampler, shaped like exact aggregations
+    return {name: aggregation
+            for name, aggregation in aggregations["sample"].items()
+            if name != "doc_count"}
+
+
+def compile_search_query(query: SearchQuery):
+    body = dict()
+    if query.aggregations:
+        body["aggs"] = compile_aggregations(query.index, query.current_class)
+
+    filters = []
+    for name, value in query.phylogeny:
+        filters.append(_nested_term(f"taxonomies.{name}",
+                                    f"taxonomies.{name}.scientificName",
+                                    value))
+    for filter_item in query.filters:
+        if filter_item.kind == CURRENT_CLASS:
+            filters.append(_nested_term(
+                f"taxonomies.{filter_item.name}",
+                f"taxonomies.{filter_item.name}.scientificName",
+                filter_item.value))
+        elif filter_item.kind == EXPERIMENT:
+            filters.append(_experiment_term(filter_item.value))
+        elif filter_item.kind == GENOME_NOTES:
+            filters.append(_genome_notes_exists())
+        elif filter_item.kind == TAXONOMY:
+            filters.append(_nested_term(
+                f"taxonomies.{filter_item.name}",
+                f"taxonomies.{filter_item.name}.scientificName",
+                filter_item.value, clause="must"))
+        else:
+            filters.append({"term": {filter_item.name: filter_item.value}})
+
+    if query.phylogeny or query.filters:
+        body["query"] = {"bool": {"filter": filters}}
+
+    # Adding search string
+    if query.search:
+        should = search_clauses(query.index, query.search, query.ngram)
+        body.setdefault("query", {"bool": {}})
+        body["query"]["bool"]["must"] = {"bool": {"should": should}}
+    return body
+
+
+def search_fields(index):
+    if 'articles' in index:
+        return ARTICLES_SEARCH_FIELDS
+    return DATA_PORTAL_SEARCH_FIELDS
+
+
+def ngram_field(field):
+    # the n-grams of a .text subfield are indexed next to it on its parent
+    if field.endswith(".text"):
+        field = field[:-len(".text")]
+    return f"{field}.ngram"
+
+
+def has_ngrams(search):
+    # shorter words have no n-grams, a search without longer ones would
+    # match nothing
+    return any(len(token) >= NGRAM_SIZE for token in NGRAM_TOKEN.findall(search))
+
+
+def search_clauses(index, search, ngram=False):
+    # substring match on every search field, through the n-gram subfields
+    # when the index has them, otherwise with leading wildcard queries
+    if ngram and has_ngrams(search):
+        return [{
+            "match": {
+                ngram_field(field): {
+                    "query": search,
+                    "operator": "and"
+                }
+            }
+        } for field in search_fields(index)]
+    return [{
+        "wildcard": {
+            field: {
+                "value": f"*{search}*",
+                "case_insensitive": True
+            }
+        }
+    } for field in search_fields(index)]
+
+
+def compile_typeahead_query(index, search, ngram=False):
+    return {
+        "query": {
+            "bool": {
+                "should": search_clauses(index, search, ngram),
+                "minimum_should_match": 1
+            }
+        },
+        "_source": search_fields(index),
+        "track_total_hits": False,
+    }
+
+
+def compile_downloader_query(query: DownloaderQuery):
+    filters = []
+    if query.taxonomy_filter:
+        filters.append({
+            "bool": {
+                "should": [
+                    _nested_term(f"taxonomies.{rank}",
+                                 f"taxonomies.{rank}.scientificName",
+                                 query.taxonomy_filter)
+                    for rank in PHYLOGENETIC_RANKS
+                ],
+                "minimum_should_match": 1
+            }
+        })
+    if query.data_status:
+        field, value = query.data_status
+        if field == GENOME_NOTES:
+            filters.append(_genome_notes_exists())
+        else:
+            filters.append({"term": {field: value}})
+    if query.experiment_type:
+        filters.append(_experiment_term(query.experiment_type,
+                                        clause="must"))
+    if query.project_name:
+        filters.append({"term": {'project_name': query.project_name}})
+
+    body = dict()
+    if filters:
+        body["query"] = {"bool": {"filter": filters}}
+    return body
+
+
+# compiled bodies are shared between requests: callers get a fresh top level
+# dict they can add keys to, but must not modify the nested structures
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _search_body(index, filter, search, current_class, phylogeny_filters,
+                 aggregations, ngram):
+    return compile_search_query(parse_search_query(
+        index, filter, search, current_class, phylogeny_filters,
+        aggregations, ngram))
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _downloader_body(taxonomy_filter, data_status, experiment_type,
+                     project_name):
+    return compile_downloader_query(parse_downloader_query(
+        taxonomy_filter, data_status, experiment_type, project_name))
+
+
+def build_search_body(index, filter=None, search=None,
+                      current_class='kingdom', phylogeny_filters=None,
+                      aggregations=True, ngram=False):
+    return dict(_search_body(index, filter, search, current_class,
+                             phylogeny_filters, aggregations, ngram))
+
+
+def build_downloader_body(taxonomy_filter=None, data_status=None,
+                          experiment_type=None, project_name=None):
+    return dict(_downloader_body(taxonomy_filter, data_status,
+                                 experiment_type, project_name))
+
+
+def query_cache_stats():
+    return {
+        'search': _search_body.cache_info()._asdict(),
+        'downloader': _downloader_body.cache_info()._asdict(),
+    }
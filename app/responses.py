@@ -0,0 +1,84 @@
+import hashlib
+from email.utils import formatdate
+
+import orjson
+from fastapi.responses import ORJSONResponse, Response
+
+from .metrics import measure
+
+
+# only the parts of ES responses that are sent on to the client, and took for
+# the metrics, everything else (_index, _score, _shards, ...) is dropped by ES
+# itself
+SEARCH_FILTER_PATH = ("took,pit_id,hits.total.value,hits.hits._id,"
+                      "hits.hits._source,hits.hits.sort,aggregations")
+HITS_FILTER_PATH = "took,pit_id,hits.hits._id,hits.hits._source,hits.hits.sort"
+MSEARCH_FILTER_PATH = ("took,responses.hits.total.value,responses.hits.hits._id,"
+                       "responses.hits.hits._source,responses.error")
+
+
+class RawJSONResponse(Response):
+    # already encoded json, e.g. a search response forwarded from ES
+    media_type = "application/json"
+
+
+def search_hits(response):
+    # filter_path drops hits.hits altogether when nothing matched
+    return response.get('hits', {}).get('hits', [])
+
+
+def search_total(response):
+    return response.get('hits', {}).get('total', {}).get('value', 0)
+
+
+def json_response(content, status_code=200, headers=None):
+    # serializes with orjson and skips FastAPI's jsonable_encoder pass
+    with measure("serialize"):
+        return ORJSONResponse(content=content, status_code=status_code,
+                              headers=headers)
+
+
+def dumps(content):
+    with measure("serialize"):
+        return orjson.dumps(content)
+
+
+async def raw_search(es, index, body, **params):
+    # sends the search on a pooled connection and returns the undecoded
+    # response body so it can be forwarded to the client as-is
+    params = {key: str(value) for key, value in params.items()
+              if value is not None}
+    raw = await es.transport.perform_raw_request(
+        "POST", f"/{index}/_search", params=params, body=orjson.dumps(body),
+        headers={"content-type": "application/json"})
+    if isinstance(raw, bytes):
+        return raw
+    return raw.encode('utf-8', 'surrogatepass')
+
+
+def etag(*parts):
+    # weak, since equivalent responses can differ in e.g. snapshot_age
+    digest = hashlib.sha1(orjson.dumps(parts, default=str)).hexdigest()
+    return f'W/"{digest}"'
+
+
+def cache_headers(tag, last_modified=None, max_age=0):
+    headers = {"ETag": tag, "Cache-Control": f"public, max-age={max_age}"}
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    return headers
+
+
+def etag_matches(if_none_match, tag):
+    # weak comparison of If-None-Match against the current etag
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tag = tag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == tag
+               for candidate in if_none_match.split(","))
+
+
+def not_modified(headers):
+    return Response(status_code=304, headers=headers)
@@ -0,0 +1,210 @@
+# Adds the .ngram subfields used by the search parameter to existing indexes,
+# e.g.
+#
+#     python -m app.search_index data_portal tracking_status articles
+#
+# The names have to be aliases of a single index. A new index is created with
+# the n-gram analyzer and subfields, the documents are copied into it with
+# _reindex and the alias is then switched over to it, so the service keeps
+# searching the old index meanwhile. Documents written to the old index during
+# the reindex aren't copied. The old index is kept and can be deleted once
+# the new one has been checked. Once the alias has been switched, add the
+# index to NGRAM_SEARCH_INDEXES.
+#
+# With --close the subfields are added to the existing index instead, which
+# has to be closed for a moment, and the documents are updated in place; the
+# index can't be searched while it is closed.
+import argparse
+import asyncio
+import copy
+import time
+
+from elasticsearch.exceptions import NotFoundError
+
+from .client import create_client, EXPORT
+from .query import NGRAM_SIZE, ngram_field, search_fields
+
+
+# index settings copied to the new index, the others are set by ES itself
+COPIED_SETTINGS = ("number_of_shards", "number_of_replicas", "analysis")
+# seconds between two checks of the reindex task
+REINDEX_POLL_INTERVAL = 10
+
+
+NGRAM_ANALYZER = "ngram_search"
+
+NGRAM_ANALYSIS = {
+    "analysis": {
+        "tokenizer": {
+            NGRAM_ANALYZER: {
+                "type": "ngram",
+                "min_gram": NGRAM_SIZE,
+                "max_gram": NGRAM_SIZE,
+                "token_chars": ["letter", "digit"]
+            }
+        },
+        "analyzer": {
+            NGRAM_ANALYZER: {
+                "type": "custom",
+                "tokenizer": NGRAM_ANALYZER,
+                "filter": ["lowercase"]
+            }
+        }
+    }
+}
+
+
+def field_mapping(properties, path):
+    # returns the mapping of a dotted field path, None if it isn't mapped
+    mapping = None
+    parts = path.split(".")
+    for position, part in enumerate(parts):
+        mapping = properties.get(part)
+        if mapping is None:
+            return None
+        if position < len(parts) - 1:
+            properties = mapping.get("properties", {})
+    return mapping
+
+
+def ngram_mapping(properties, field):
+    # builds the put mapping body that adds the ngram subfield to the field
+    # holding it, repeating the types of the objects above it
+    subfield_path = ngram_field(field)
+    parent_path, _, subfield = subfield_path.rpartition(".")
+    parent = field_mapping(properties, parent_path)
+    if parent is None:
+        return None
+    mapping = {key: value for key, value in parent.items()
+               if key not in ("properties", "fields")}
+    mapping["fields"] = dict(parent.get("fields", {}))
+    mapping["fields"][subfield] = {"type": "text", "analyzer": NGRAM_ANALYZER}
+
+    parts = parent_path.split(".")
+    for depth in range(len(parts) - 1, 0, -1):
+        container = field_mapping(properties, ".".join(parts[:depth]))
+        wrapper = {"properties": {parts[depth]: mapping}}
+        if container.get("type"):
+            wrapper["type"] = container["type"]
+        mapping = wrapper
+    return {"properties": {parts[0]: mapping}}
+
+
+def merge_mapping(mapping, update):
+    # adds update to the mapping, recursing into the objects both have
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(mapping.get(key), dict):
+            merge_mapping(mapping[key], value)
+        else:
+            mapping[key] = copy.deepcopy(value)
+    return mapping
+
+
+def ngram_index_body(index, index_settings, index_mapping):
+    # the settings and mappings of the index with the n-gram analyzer and the
+    # subfields of the search fields added
+    settings = {key: value for key, value in index_settings.items()
+                if key in COPIED_SETTINGS}
+    settings = merge_mapping(settings, NGRAM_ANALYSIS)
+    properties = index_mapping.get("mappings", {}).get("properties", {})
+    mappings = copy.deepcopy(index_mapping.get("mappings", {}))
+    for field in search_fields(index):
+        body = ngram_mapping(properties, field)
+        if body is None:
+            print(f"{index}: {field} isn't mapped, skipped")
+            continue
+        mappings = merge_mapping(mappings, body)
+    return {"settings": {"index": settings}, "mappings": mappings}
+
+
+async def reindex_with_search_fields(es, alias):
+    try:
+        aliases = await es.indices.get_alias(name=alias)
+    except NotFoundError:
+        aliases = {}
+    if len(aliases) != 1:
+        raise SystemExit(f"{alias} has to be an alias of a single index, "
+                         f"or be migrated in place with --close")
+    old_index = next(iter(aliases))
+    settings = await es.indices.get_settings(index=old_index)
+    mapping = await es.indices.get_mapping(index=old_index)
+    new_index = f"{alias}-ngram-{time.strftime('%Y%m%d%H%M%S')}"
+
+    body = ngram_index_body(alias, settings[old_index]["settings"]["index"],
+                            mapping[old_index])
+    print(f"{alias}: creating {new_index}")
+    await es.indices.create(index=new_index, body=body)
+    task = await es.reindex(body={"source": {"index": old_index},
+                                  "dest": {"index": new_index}},
+                            wait_for_completion=False)
+    print(f"{alias}: reindex task {task['task']}")
+    while True:
+        await asyncio.sleep(REINDEX_POLL_INTERVAL)
+        status = await es.tasks.get(task_id=task["task"])
+        if status.get("completed"):
+            break
+    failures = status.get("response", {}).get("failures") or status.get("error")
+    if failures:
+        raise SystemExit(f"{alias}: reindex into {new_index} failed, "
+                         f"{alias} still points to {old_index}: {failures}")
+
+    await es.indices.refresh(index=new_index)
+    await es.indices.update_aliases(body={"actions": [
+        {"remove": {"index": old_index, "alias": alias}},
+        {"add": {"index": new_index, "alias": alias}},
+    ]})
+    print(f"{alias}: now points to {new_index}, {old_index} can be deleted")
+
+
+async def add_search_fields_in_place(es, index):
+    settings = await es.indices.get_settings(index=index)
+    for concrete_index, index_settings in settings.items():
+        analysis = index_settings["settings"]["index"].get("analysis", {})
+        if NGRAM_ANALYZER in analysis.get("analyzer", {}):
+            continue
+        print(f"{concrete_index}: closing to add the {NGRAM_ANALYZER} analyzer")
+        await es.indices.close(index=concrete_index)
+        try:
+            await es.indices.put_settings(index=concrete_index,
+                                          body=NGRAM_ANALYSIS)
+        finally:
+            await es.indices.open(index=concrete_index)
+
+    mappings = await es.indices.get_mapping(index=index)
+    for concrete_index, index_mapping in mappings.items():
+        properties = index_mapping["mappings"].get("properties", {})
+        for field in search_fields(index):
+            body = ngram_mapping(properties, field)
+            if body is None:
+                print(f"{concrete_index}: {field} isn't mapped, skipped")
+                continue
+            print(f"{concrete_index}: adding {ngram_field(field)}")
+            await es.indices.put_mapping(index=concrete_index, body=body)
+
+    # re-indexes every document in place so the new subfields are filled
+    task = await es.update_by_query(index=index, conflicts="proceed",
+                                    wait_for_completion=False)
+    print(f"{index}: update by query task {task['task']}")
+
+
+async def main(args):
+    es = create_client(EXPORT)
+    try:
+        for index in args.indexes:
+            if args.close:
+                await add_search_fields_in_place(es, index)
+            else:
+                await reindex_with_search_fields(es, index)
+    finally:
+        await es.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Add the n-gram search subfields to indexes")
+    parser.add_argument("indexes", nargs="+",
+                        help="aliases of the indexes to migrate")
+    parser.add_argument("--close", action="store_true",
+                        help="update the indexes in place, closing them "
+                             "while the analyzer is added")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,107 @@
+from .constants import DATA_PORTAL_AGGREGATIONS, PHYLOGENETIC_RANKS
+from .export import export_pages
+
+
+# record fields counted per taxon next to the number of records
+TAXONOMY_STATUS_FIELDS = ("currentStatus",) + tuple(DATA_PORTAL_AGGREGATIONS)
+TAXONOMY_SOURCE = [f"taxonomies.{rank}.scientificName"
+                   for rank in PHYLOGENETIC_RANKS] + list(TAXONOMY_STATUS_FIELDS)
+
+
+class TaxonomyNode:
+    __slots__ = ("name", "rank", "parent", "count", "statuses", "children")
+
+    def __init__(self, name, rank, parent=None):
+        self.name = name
+        self.rank = rank
+        self.parent = parent
+        self.count = 0
+        self.statuses = dict()
+        self.children = dict()
+
+    def add(self, record):
+        self.count += 1
+        for field in TAXONOMY_STATUS_FIELDS:
+            value = record.get(field)
+            if value is None or isinstance(value, (list, dict)):
+                continue
+            counts = self.statuses.setdefault(field, dict())
+            counts[value] = counts.get(value, 0) + 1
+
+    def info(self):
+        return {
+            'name': self.name,
+            'rank': self.rank,
+            'count': self.count,
+            'statuses': self.statuses,
+            'children': len(self.children),
+        }
+
+
+class TaxonomyTree:
+    # taxa of PHYLOGENETIC_RANKS with the number of records below them; a
+    # record without a rank is attached to its closest ranked ancestor
+    def __init__(self):
+        self.root = TaxonomyNode(None, None)
+        self.nodes = dict()
+        self.records = 0
+
+    def add(self, record):
+        self.records += 1
+        self.root.add(record)
+        node = self.root
+        taxonomies = record.get('taxonomies') or {}
+        for rank in PHYLOGENETIC_RANKS:
+            name = taxon_name(taxonomies, rank)
+            if name is None:
+                continue
+            # a taxon is a single node even if records disagree on its parent
+            child = self.nodes.get((rank, name))
+            if child is None:
+                child = TaxonomyNode(name, rank, node)
+                self.nodes[(rank, name)] = child
+            node.children.setdefault(name, child)
+            child.add(record)
+            node = child
+
+    def find(self, rank=None, name=None):
+        if name is None:
+            return self.root
+        return self.nodes.get((rank, name))
+
+    def children(self, rank=None, name=None):
+        node = self.find(rank, name)
+        if node is None:
+            return None
+        return sorted((child.info() for child in node.children.values()),
+                      key=lambda child: (-child['count'], child['name']))
+
+    def lineage(self, rank, name):
+        node = self.find(rank, name)
+        if node is None:
+            return None
+        lineage = []
+        while node is not self.root:
+            lineage.append(node.info())
+            node = node.parent
+        lineage.reverse()
+        return lineage
+
+
+def taxon_name(taxonomies, rank):
+    # taxonomies.{rank} is a nested field, so it may come back as a list
+    taxon = taxonomies.get(rank)
+    if isinstance(taxon, list):
+        taxon = taxon[0] if taxon else None
+    if not isinstance(taxon, dict):
+        return None
+    return taxon.get('scientificName') or None
+
+
+async def load_taxonomy_tree(es, index):
+    tree = TaxonomyTree()
+    body = {"_source": TAXONOMY_SOURCE}
+    async for hits in export_pages(es, index, body):
+        for hit in hits:
+            tree.add(hit.get('_source', {}))
+    return tree
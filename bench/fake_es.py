@@ -0,0 +1,193 @@
+# Elasticsearch stand-in for the benchmarks: a connection class for the
+# AsyncElasticsearch client that answers from synthetic documents, or from
+# recorded responses, after a configurable delay.
+import asyncio
+import json
+import re
+from urllib.parse import unquote
+
+from elasticsearch import AsyncConnection
+
+from app.constants import PHYLOGENETIC_RANKS
+
+
+STATUSES = ("Waiting", "Submitted", "Done")
+INFO = {
+    "name": "fake-es",
+    "cluster_name": "bench",
+    "version": {"number": "7.17.0", "build_flavor": "default"},
+    "tagline": "You Know, for Search",
+}
+
+
+class FakeCluster:
+    # documents: number of synthetic records in every index
+    # latency: seconds added to every request
+    # padding: extra bytes in every _source to simulate bigger records
+    # recordings: {"METHOD /path": response} returned instead of synthetic
+    #             responses for the matching requests
+    def __init__(self, documents=5000, latency=0.005, padding=0,
+                 recordings=None):
+        self.latency = latency
+        self.recordings = recordings or dict()
+        self.requests = 0
+        self.docs = [self._document(number, padding)
+                     for number in range(documents)]
+        self.ids = {doc["_id"]: number for number, doc in enumerate(self.docs)}
+        self.organisms = {doc["_source"]["organism"]: number
+                          for number, doc in enumerate(self.docs)}
+
+    def _document(self, number, padding):
+        source = {
+            "organism": f"Organism {number}",
+            "commonName": f"common name {number}",
+            "commonNameSource": "NCBI",
+            "currentStatus": STATUSES[number % 3],
+            "biosamples": STATUSES[number % 2],
+            "raw_data": STATUSES[number % 3],
+            "mapped_reads": STATUSES[(number + 1) % 3],
+            "assemblies_status": STATUSES[(number + 2) % 3],
+            "annotation_status": STATUSES[number % 2],
+            "annotation_complete": STATUSES[(number + 1) % 2],
+            "project_name": "ATOL",
+            "tax_id": str(number),
+            "taxonomies": {
+                rank: [{"scientificName": f"{rank} {number % (3 ** depth)}"}]
+                for depth, rank in enumerate(PHYLOGENETIC_RANKS, start=1)
+            },
+        }
+        if padding:
+            source["padding"] = "x" * padding
+        return {"_index": "data_portal", "_type": "_doc",
+                "_id": f"id{number}", "_score": 1.0, "_source": source}
+
+    def handle(self, method, path, params, body):
+        recorded = self.recordings.get(f"{method} {path}")
+        if recorded is not None:
+            return 200, recorded
+        parts = [unquote(part) for part in path.strip("/").split("/") if part]
+        if not parts:
+            return 200, INFO
+        if parts[-1] == "_pit":
+            if method == "DELETE":
+                return 200, {"succeeded": True, "num_freed": 1}
+            return 200, {"id": f"pit-{parts[0]}-{self.requests}"}
+        if parts[-1] == "_search":
+            return 200, self.search(params, json.loads(body) if body else {})
+        if parts[-1] == "_msearch":
+            lines = [json.loads(line) for line in body.splitlines() if line]
+            return 200, {"responses": [self.search({}, search)
+                                       for search in lines[1::2]]}
+        if parts[-1] == "_mget":
+            return 200, {"docs": [self.get(doc_id)
+                                  for doc_id in json.loads(body)["ids"]]}
+        if len(parts) == 3 and parts[1] == "_doc":
+            doc = self.get(parts[2])
+            return (200 if doc["found"] else 404), doc
+        if "_stats" in parts:
+            return 200, self.stats(parts[0])
+        return 400, {"error": f"fake-es doesn't support {method} {path}"}
+
+    def get(self, doc_id):
+        number = self.ids.get(doc_id)
+        if number is None:
+            return {"_id": doc_id, "found": False}
+        return dict(self.docs[number], found=True)
+
+    def matches(self, query):
+        # only the lookups the service does by id or organism are evaluated,
+        # any other query matches every document
+        text = json.dumps(query)
+        names = re.findall(r'"(?:_id|organism)": (\[[^\]]*\]|"[^"]*")', text)
+        if not names:
+            return range(len(self.docs))
+        numbers = set()
+        for name in names:
+            for value in json.loads(f"[{name}]" if name.startswith('"') else name):
+                for lookup in (self.ids, self.organisms):
+                    if value in lookup:
+                        numbers.add(lookup[value])
+        return sorted(numbers)
+
+    def search(self, params, body):
+        numbers = self.matches(body.get("query", {}))
+        if "slice" in body:
+            slice_id, slices = body["slice"]["id"], body["slice"]["max"]
+            numbers = [number for number in numbers
+                       if number % slices == slice_id]
+        size = int(body.get("size", params.get("size", 10)))
+        start = int(params.get("from", body.get("from", 0)))
+        if "search_after" in body:
+            after = body["search_after"][-1]
+            numbers = [number for number in numbers if number > after]
+            start = 0
+        page = numbers[start:start + size]
+        hits = []
+        for number in page:
+            hit = dict(self.docs[number])
+            if "sort" in body:
+                hit["sort"] = [number]
+            hits.append(hit)
+        response = {
+            "took": 1,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"total": {"value": len(numbers), "relation": "eq"},
+                     "max_score": 1.0, "hits": hits},
+        }
+        if "pit" in body:
+            response["pit_id"] = body["pit"]["id"]
+        if "aggs" in body:
+            response["aggregations"] = {
+                name: {"buckets": [{"key": status, "doc_count": len(numbers) // 3}
+                                   for status in STATUSES]}
+                for name in body["aggs"]
+            }
+        return response
+
+    def stats(self, index):
+        return {
+            "_all": {"primaries": {
+                "docs": {"count": len(self.docs)},
+                "indexing": {"index_total": len(self.docs), "delete_total": 0},
+                "refresh": {"total": 1, "external_total": 1},
+            }},
+            "indices": {index: {"uuid": "bench"}},
+        }
+
+
+class FakeConnection(AsyncConnection):
+    # the cluster is shared by every connection, see install()
+    cluster = None
+
+    async def perform_request(self, method, url, params=None, body=None,
+                              timeout=None, ignore=(), headers=None):
+        cluster = self.cluster
+        cluster.requests += 1
+        if cluster.latency:
+            await asyncio.sleep(cluster.latency)
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        path = url.split("?", 1)[0]
+        status, response = cluster.handle(method, path, params or {}, body)
+        raw_data = json.dumps(response)
+        if not 200 <= status < 300 and status not in ignore:
+            self._raise_error(status, raw_data)
+        return status, {"x-elastic-product": "Elasticsearch",
+                        "content-type": "application/json"}, raw_data
+
+    async def close(self):
+        pass
+
+
+def install(cluster):
+    # points the service at the fake cluster, before the app starts up
+    import app.main
+    from app.client import create_client, BROWSE, EXPORT
+
+    FakeConnection.cluster = cluster
+    app.main.es = create_client(BROWSE, ["http://fake-es:9200"],
+                                connection_class=FakeConnection)
+    app.main.export_es = create_client(EXPORT, ["http://fake-es:9200"],
+                                       connection_class=FakeConnection)
+    return app.main.es
@@ -0,0 +1,272 @@
+# Latency/throughput benchmark of the service against the fake Elasticsearch
+# in bench/fake_es.py, run from the repository root:
+#
+#     python -m bench.run --requests 500 --concurrency 20 --latency 5
+#
+# Every scenario sends its requests in-process through the ASGI app and
+# reports p50/p99 latency, requests/s, CPU time per request and the peak RSS.
+# With --processes N the scenarios run at the same time in N processes that
+# share one cache database, like N uvicorn workers, and report the total
+# requests/s and the shared cache hit rate.
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('ES_HOST', 'http://fake-es:9200')
+
+from .fake_es import FakeCluster, install  # noqa: E402
+
+
+DOWNLOAD_QUERY = {
+    "pageIndex": 0, "pageSize": 15, "sortValue": "", "filterValue": "",
+    "currentClass": "kingdom", "phylogeny_filters": "",
+    "index_name": "data_portal", "downloadOption": "metadata",
+}
+
+
+def scenarios(documents):
+    def browse():
+        offset = random.randrange(0, min(documents, 9000), 15)
+        return "GET", f"/api/data_portal?offset={offset}&limit=15", None
+
+    def browse_filtered():
+        status = random.choice(("Done", "Waiting", "Submitted"))
+        return "GET", f"/api/data_portal?filter=biosamples:{status}&search=organism", None
+
+    def details():
+        return "GET", f"/api/data_portal/id{random.randrange(documents)}", None
+
+    def summary():
+        return "GET", "/api/summary", None
+
+    def data_download():
+        return "POST", "/api/data-download", DOWNLOAD_QUERY
+
+    def downloader():
+        return ("GET", "/api/downloader_utility_data/?taxonomy_filter="
+                "&data_status=&experiment_type=&project_name=ATOL", None)
+
+    def downloader_species():
+        species = ",".join(f"Organism {random.randrange(documents)}"
+                           for _ in range(50))
+        return ("GET", "/api/downloader_utility_data_with_species/"
+                f"?species_list={species}&project_name=ATOL", None)
+
+    return {
+        "browse": browse,
+        "browse_filtered": browse_filtered,
+        "details": details,
+        "summary": summary,
+        "data_download": data_download,
+        "downloader": downloader,
+        "downloader_species": downloader_species,
+    }
+
+
+async def call(app, method, url, payload=None):
+    # minimal ASGI client, returns the status and the size of the body
+    path, _, query = url.partition("?")
+    body = json.dumps(payload).encode() if payload is not None else b""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.replace(" ", "%20").encode(), "root_path": "",
+        "headers": [(b"host", b"bench"), (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+    received = False
+    status = None
+    size = 0
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.sleep(3600)
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, size
+
+
+async def run_scenario(app, make_request, requests, concurrency):
+    latencies = []
+    errors = 0
+    transferred = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors, transferred
+        for _ in remaining:
+            method, url, payload = make_request()
+            started = time.perf_counter()
+            status, size = await call(app, method, url, payload)
+            latencies.append(time.perf_counter() - started)
+            transferred += size
+            if status >= 400:
+                errors += 1
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1,
+                                int(len(latencies) * 0.99))] * 1000,
+        "requests_per_s": requests / elapsed,
+        "cpu_ms_per_request": cpu / requests * 1000,
+        "kb_per_request": transferred / requests / 1024,
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def print_header():
+    print(f"{'scenario':<20}{'p50 ms':>10}{'p99 ms':>10}{'req/s':>10}"
+          f"{'cpu ms/req':>12}{'kB/req':>10}{'errors':>8}")
+
+
+def print_result(name, result):
+    print(f"{name:<20}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+          f"{result['requests_per_s']:>10.1f}"
+          f"{result['cpu_ms_per_request']:>12.3f}"
+          f"{result['kb_per_request']:>10.1f}{result['errors']:>8}")
+
+
+async def main(args):
+    recordings = None
+    if args.recordings:
+        with open(args.recordings) as recordings_file:
+            recordings = json.load(recordings_file)
+    cluster = FakeCluster(args.documents, args.latency / 1000, args.padding,
+                          recordings)
+    install(cluster)
+    from app.main import app, aggregation_cache, details_cache
+
+    all_scenarios = scenarios(args.documents)
+    selected = args.scenarios.split(",") if args.scenarios else list(all_scenarios)
+
+    await app.router.startup()
+    if args.start_at:
+        # the processes of a --processes run start their scenarios together
+        await asyncio.sleep(max(0.0, args.start_at - time.time()))
+    results = dict()
+    try:
+        if not args.json:
+            print_header()
+        for name in selected:
+            requests = args.requests
+            if name in ("data_download", "downloader"):
+                requests = max(1, requests // 50)
+            results[name] = await run_scenario(app, all_scenarios[name],
+                                               requests, args.concurrency)
+            if not args.json:
+                print_result(name, results[name])
+    finally:
+        await app.router.shutdown()
+    if args.json:
+        print(json.dumps({
+            "scenarios": results,
+            "es_requests": cluster.requests,
+            "peak_rss_mb": peak_rss_mb(),
+            "caches": {"aggregations": aggregation_cache.stats(),
+                       "details": details_cache.stats()},
+        }))
+        return
+    print(f"peak RSS {peak_rss_mb():.1f} MB, {cluster.requests} ES requests")
+
+
+def run_processes(args):
+    # one child per process, all sharing a fresh cache database
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, WEB_CONCURRENCY=str(args.processes),
+                   SHARED_CACHE_PATH=os.path.join(directory, "cache.sqlite3"))
+        command = [sys.executable, "-m", "bench.run", "--json",
+                   "--start-at", str(time.time() + 5)]
+        for option in ("requests", "concurrency", "latency", "documents",
+                       "padding", "scenarios", "recordings"):
+            value = getattr(args, option)
+            if value:
+                command += [f"--{option}", str(value)]
+        children = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                                     text=True)
+                    for _ in range(args.processes)]
+        outputs = [json.loads(child.communicate()[0].strip().splitlines()[-1])
+                   for child in children]
+
+    print(f"{args.processes} processes")
+    print_header()
+    for name in outputs[0]["scenarios"]:
+        results = [output["scenarios"][name] for output in outputs]
+        print_result(name, {
+            "requests": sum(result["requests"] for result in results),
+            "errors": sum(result["errors"] for result in results),
+            "p50_ms": statistics.median(result["p50_ms"] for result in results),
+            "p99_ms": max(result["p99_ms"] for result in results),
+            "requests_per_s": sum(result["requests_per_s"] for result in results),
+            "cpu_ms_per_request": statistics.mean(
+                result["cpu_ms_per_request"] for result in results),
+            "kb_per_request": statistics.mean(
+                result["kb_per_request"] for result in results),
+        })
+    for cache in ("aggregations", "details"):
+        hits = sum(output["caches"][cache]["hits"] for output in outputs)
+        misses = sum(output["caches"][cache]["misses"] for output in outputs)
+        print(f"{cache} cache hit rate "
+              f"{hits / (hits + misses) if hits + misses else 0.0:.2f}")
+    print(f"peak RSS {max(output['peak_rss_mb'] for output in outputs):.1f} MB "
+          f"per process, {sum(output['es_requests'] for output in outputs)} "
+          "ES requests")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API against a fake Elasticsearch")
+    parser.add_argument("--requests", type=int, default=500,
+                        help="requests per scenario, exports send 1/50th")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=5,
+                        help="milliseconds added to every ES request")
+    parser.add_argument("--documents", type=int, default=5000,
+                        help="number of documents in the fake indexes")
+    parser.add_argument("--padding", type=int, default=0,
+                        help="extra bytes in every document")
+    parser.add_argument("--scenarios", default="",
+                        help="comma separated subset of the scenarios")
+    parser.add_argument("--recordings",
+                        help='json file of {"METHOD /path": response}')
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes sharing the caches")
+    parser.add_argument("--json", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.processes > 1:
+        run_processes(args)
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,89 @@
+# Cold start benchmark: starts the service in fresh processes against the
+# fake Elasticsearch and reports the import time, the startup warm-up time
+# and the latency of the first requests next to the steady-state latency:
+#
+#     python -m bench.startup --runs 5 --latency 5
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('ES_HOST', 'http://fake-es:9200')
+
+FIRST_REQUESTS = ("summary", "browse", "details")
+STEADY_REQUESTS = 20
+
+
+async def child(args):
+    started = time.perf_counter()
+    from app.main import app, startup_report
+    result = {"import_s": time.perf_counter() - started}
+
+    from .fake_es import FakeCluster, install
+    from .run import call, scenarios
+    install(FakeCluster(args.documents, args.latency / 1000))
+
+    started = time.perf_counter()
+    await app.router.startup()
+    result["startup_s"] = time.perf_counter() - started
+    result["ready"] = startup_report["ready"]
+
+    requests = scenarios(args.documents)
+    for name in FIRST_REQUESTS:
+        method, url, payload = requests[name]()
+        started = time.perf_counter()
+        await call(app, method, url, payload)
+        result[f"first_{name}_ms"] = (time.perf_counter() - started) * 1000
+        latencies = []
+        for _ in range(STEADY_REQUESTS):
+            method, url, payload = requests[name]()
+            started = time.perf_counter()
+            await call(app, method, url, payload)
+            latencies.append(time.perf_counter() - started)
+        result[f"steady_{name}_ms"] = statistics.median(latencies) * 1000
+    await app.router.shutdown()
+    print(json.dumps(result))
+
+
+def main(args):
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "bench.startup", "--child",
+             "--latency", str(args.latency), "--documents", str(args.documents)],
+            check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'measure':<24}{'median':>10}{'max':>10}")
+    for key in results[0]:
+        if key == "ready":
+            continue
+        values = [result[key] for result in results]
+        scale = 1000 if key.endswith("_s") else 1
+        name = key[:-2] + "_ms" if key.endswith("_s") else key
+        print(f"{name:<24}{statistics.median(values) * scale:>10.2f}"
+              f"{max(values) * scale:>10.2f}")
+    print(f"ready after startup in {sum(r['ready'] for r in results)}"
+          f"/{len(results)} runs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the cold start against a fake Elasticsearch")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="number of fresh processes started")
+    parser.add_argument("--latency", type=float, default=5,
+                        help="milliseconds added to every ES request")
+    parser.add_argument("--documents", type=int, default=5000,
+                        help="number of documents in the fake indexes")
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(child(args))
+    else:
+        main(args)
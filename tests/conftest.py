@@ -0,0 +1,5 @@
+import os
+
+# app.main creates its ES clients on import, the tests replace them with
+# clients of the benchmark fake cluster
+os.environ.setdefault('ES_HOST', 'http://fake-es:9200')
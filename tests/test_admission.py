@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from app.admission import Lane, Saturated
+
+
+def test_requests_wait_in_arrival_order():
+    async def run():
+        lane = Lane("test", 1, 10, 1, 1)
+        order = []
+
+        async def request(name):
+            await lane.acquire()
+            order.append(name)
+            await asyncio.sleep(0)
+            lane.release()
+
+        await lane.acquire()
+        tasks = [asyncio.create_task(request(name)) for name in "abc"]
+        await asyncio.sleep(0)
+        assert lane.stats()["queued"] == 3
+        lane.release()
+        await asyncio.gather(*tasks)
+        return lane, order
+
+    lane, order = asyncio.run(run())
+    assert order == ["a", "b", "c"]
+    assert lane.stats() == {"limit": 1, "active": 0, "queued": 0,
+                            "admitted": 4, "rejected": 0}
+
+
+def test_full_queue_is_rejected():
+    async def run():
+        lane = Lane("test", 1, 1, 1, 1)
+        await lane.acquire()
+        waiting = asyncio.create_task(lane.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Saturated):
+            await lane.acquire()
+        lane.release()
+        await waiting
+        return lane
+
+    assert asyncio.run(run()).active == 1
+
+
+def test_queue_timeout_is_rejected():
+    async def run():
+        lane = Lane("test", 1, 10, 0.01, 1)
+        await lane.acquire()
+        with pytest.raises(Saturated):
+            await lane.acquire()
+        return lane
+
+    lane = asyncio.run(run())
+    assert (lane.active, len(lane.waiters)) == (1, 0)
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        lane = Lane("test", 1, 10, 1, 1)
+        await lane.acquire()
+        waiting = asyncio.create_task(lane.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        lane.release()
+        return lane
+
+    lane = asyncio.run(run())
+    assert (lane.active, len(lane.waiters)) == (0, 0)
+
+
+def test_slot_handed_to_a_cancelled_waiter_is_not_lost():
+    async def run():
+        lane = Lane("test", 1, 10, 1, 1)
+        await lane.acquire()
+        waiting = asyncio.create_task(lane.acquire())
+        await asyncio.sleep(0)
+        # the slot is handed over and the waiter cancelled before it resumes,
+        # depending on the Python version the wait is then cancelled or not
+        lane.release()
+        waiting.cancel()
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            acquired = False
+        else:
+            acquired = True
+        return lane, acquired
+
+    lane, acquired = asyncio.run(run())
+    assert (lane.active, len(lane.waiters)) == (int(acquired), 0)
@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+from elasticsearch.exceptions import ConnectionError
+
+from app.cache import IndexVersions
+
+
+class StatsES:
+    # answers indices.stats with the given document counts, one per call,
+    # an exception in the list fails that call
+    def __init__(self, *counts):
+        self.counts = list(counts)
+        self.calls = 0
+        self.indices = SimpleNamespace(stats=self.stats)
+
+    async def stats(self, index, metric):
+        self.calls += 1
+        await asyncio.sleep(0)
+        count = self.counts.pop(0)
+        if isinstance(count, Exception):
+            raise count
+        return {
+            "_all": {"primaries": {
+                "docs": {"count": count},
+                "indexing": {"index_total": count, "delete_total": 0},
+                "refresh": {"total": 1, "external_total": 1},
+            }},
+            "indices": {index: {}},
+        }
+
+
+def test_concurrent_checks_share_one_stats_request():
+    es = StatsES(10)
+    versions = IndexVersions(60, {"data_portal"})
+
+    async def run():
+        return await asyncio.gather(*(versions.get(es, "data_portal")
+                                      for _ in range(20)))
+
+    results = asyncio.run(run())
+    assert es.calls == 1
+    assert len(set(results)) == 1 and results[0] is not None
+
+
+def test_unknown_indexes_are_not_versioned():
+    es = StatsES()
+    versions = IndexVersions(0, {"data_portal"})
+    for index in ("*", "_all", "random"):
+        assert asyncio.run(versions.get(es, index)) is None
+    assert es.calls == 0
+    assert versions.versions == {}
+
+
+def test_changed_version_calls_the_listeners():
+    es = StatsES(10, 10, 11)
+    versions = IndexVersions(0, {"data_portal"})
+    changed = []
+    versions.listeners.append(changed.append)
+
+    first = asyncio.run(versions.get(es, "data_portal"))
+    assert asyncio.run(versions.get(es, "data_portal")) == first
+    assert changed == []
+    assert asyncio.run(versions.get(es, "data_portal")) != first
+    assert changed == ["data_portal"]
+
+
+def test_failed_stats_keep_the_last_version():
+    es = StatsES(10, ConnectionError("N/A", "refused"))
+    versions = IndexVersions(0, {"data_portal"})
+    changed = []
+    versions.listeners.append(changed.append)
+
+    first = asyncio.run(versions.get(es, "data_portal"))
+    assert asyncio.run(versions.get(es, "data_portal")) == first
+    assert changed == []
@@ -0,0 +1,153 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from elasticsearch.exceptions import (ConnectionError, ConnectionTimeout,
+                                      NotFoundError, TransportError)
+
+from app import client
+from app.client import (CircuitBreaker, CircuitOpen, ManagedTransport,
+                        idempotent, retryable)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(client, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(3, 10)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    breaker.record_success()
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert not breaker.allow()
+    assert breaker.stats() == {"state": "open", "failures": 3, "opened": 1,
+                               "rejected": 1}
+
+
+def test_breaker_lets_a_single_probe_through(clock):
+    breaker = CircuitBreaker(1, 10)
+    breaker.record_failure()
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    # only one probe at a time
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.stats()["state"] == "closed"
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(1, 10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+    assert breaker.stats()["opened"] == 2
+
+
+def test_released_probe_lets_the_next_one_through(clock):
+    breaker = CircuitBreaker(1, 10)
+    breaker.record_failure()
+    clock.now += 10
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_retryable():
+    assert retryable(ConnectionError("N/A", "refused"))
+    assert retryable(ConnectionTimeout("TIMEOUT", "timed out"))
+    assert retryable(TransportError(503, "unavailable"))
+    assert retryable(TransportError(429, "too many requests"))
+    assert not retryable(NotFoundError(404, "index_not_found_exception"))
+    assert not retryable(TransportError(400, "parsing_exception"))
+
+
+@pytest.mark.parametrize("method, url, expected", [
+    ("GET", "/data_portal/_doc/1", True),
+    ("HEAD", "/", True),
+    ("POST", "/data_portal/_search", True),
+    ("POST", "/data_portal/_search?size=0", True),
+    ("POST", "/_msearch", True),
+    ("POST", "/data_portal/_count/", True),
+    ("POST", "/data_portal/_doc", False),
+    ("DELETE", "/_pit", False),
+    ("POST", "/data_portal/_update_by_query", False),
+])
+def test_idempotent(method, url, expected):
+    assert idempotent(method, url) is expected
+
+
+def send(transport, method, url, failures):
+    # runs transport.send with a request failing with the given errors first
+    calls = []
+
+    async def perform():
+        calls.append(None)
+        if len(calls) <= len(failures):
+            raise failures[len(calls) - 1]
+        return "ok"
+
+    async def run():
+        return await transport.send(method, url, perform)
+
+    try:
+        return asyncio.run(run()), len(calls)
+    except Exception as exc:
+        return exc, len(calls)
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    monkeypatch.setattr(client, "ES_RETRY_BACKOFF", 0)
+    return ManagedTransport(["http://fake-es:9200"], retries=2,
+                            breaker=CircuitBreaker(10, 10))
+
+
+def test_idempotent_requests_are_retried(transport):
+    assert send(transport, "POST", "/i/_search",
+                [TransportError(503, "unavailable")] * 2) == ("ok", 3)
+
+
+def test_retries_are_bounded(transport):
+    error, calls = send(transport, "POST", "/i/_search",
+                        [TransportError(503, "unavailable")] * 3)
+    assert (error.status_code, calls) == (503, 3)
+    assert transport.breaker.failures == 3
+
+
+@pytest.mark.parametrize("method, url, failure", [
+    ("POST", "/i/_doc", TransportError(503, "unavailable")),
+    ("POST", "/i/_search", TransportError(400, "parsing_exception")),
+    ("POST", "/i/_search", ConnectionTimeout("TIMEOUT", "timed out")),
+])
+def test_requests_that_are_not_retried(transport, method, url, failure):
+    assert send(transport, method, url, [failure]) == (failure, 1)
+
+
+def test_open_breaker_fails_without_sending(transport, clock):
+    transport.breaker = CircuitBreaker(1, 10)
+    send(transport, "GET", "/", [ConnectionError("N/A", "refused")] * 3)
+    error, calls = send(transport, "GET", "/", [])
+    assert isinstance(error, CircuitOpen)
+    assert calls == 0
@@ -0,0 +1,183 @@
+import asyncio
+
+import pytest
+
+from app import export
+from app.client import create_client, EXPORT
+from app.export import _SortKey, export_pages, without_sort
+from bench.fake_es import FakeCluster, FakeConnection
+
+
+class SlicedES:
+    # point in time searches over a fixed list of documents, sorted and
+    # sliced like ES does it; fail_slice makes the second page of that slice
+    # fail. Every search returns a new point in time id, and only the latest
+    # one closes the point in time
+    def __init__(self, docs, fail_slice=None):
+        self.docs = docs
+        self.fail_slice = fail_slice
+        self.searches = 0
+        self.open_pits = dict()
+
+    async def open_point_in_time(self, index, keep_alive):
+        pit_id = f"pit-{len(self.open_pits)}"
+        self.open_pits[pit_id] = pit_id
+        return {"id": pit_id}
+
+    async def close_point_in_time(self, body):
+        root = body["id"].partition("~")[0]
+        if self.open_pits.get(root) == body["id"]:
+            del self.open_pits[root]
+
+    def sorted_hits(self, clauses):
+        hits = list(enumerate(self.docs))
+        # stable sorts from the last clause to the first, missing values last
+        for clause in reversed(clauses):
+            field, options = next(iter(clause.items()))
+            if field == "_shard_doc":
+                continue
+            present = [hit for hit in hits if hit[1].get(field) is not None]
+            missing = [hit for hit in hits if hit[1].get(field) is None]
+            present.sort(key=lambda hit: hit[1][field],
+                         reverse=options["order"] == "desc")
+            hits = present + missing
+        return [{"_id": doc["id"], "_source": doc,
+                 "sort": [doc.get(next(iter(clause)))
+                          for clause in clauses[:-1]] + [position]}
+                for position, doc in hits]
+
+    async def search(self, body, filter_path=None):
+        self.searches += 1
+        await asyncio.sleep(0)
+        root = body["pit"]["id"].partition("~")[0]
+        assert root in self.open_pits
+        self.open_pits[root] = f"{root}~{self.searches}"
+        hits = self.sorted_hits(body["sort"])
+        if "slice" in body:
+            slice_id, slices = body["slice"]["id"], body["slice"]["max"]
+            hits = [hit for hit in hits if hit["sort"][-1] % slices == slice_id]
+            if slice_id == self.fail_slice and "search_after" in body:
+                raise RuntimeError("slice failed")
+        if "search_after" in body:
+            position = [hit["sort"] for hit in hits].index(body["search_after"])
+            hits = hits[position + 1:]
+        return {"pit_id": self.open_pits[root],
+                "hits": {"hits": hits[:body["size"]]}}
+
+
+def documents(count=40):
+    # rank is missing on every fifth document and has duplicates
+    return [{"id": f"doc{number}", "name": f"name {number % 7:02d}",
+             "rank": None if number % 5 == 0 else number % 4}
+            for number in range(count)]
+
+
+async def collect(pages):
+    ids = []
+    async for hits in pages:
+        ids.extend(hit["_id"] for hit in hits)
+    return ids
+
+
+def export_ids(es, sort=None, slices=1, batch_size=3):
+    return asyncio.run(collect(export_pages(es, "index", {}, sort, slices,
+                                            batch_size)))
+
+
+def test_sort_key_orders_missing_values_last():
+    keys = [_SortKey([value], ["desc"]) for value in (1, None, 3, 2)]
+    assert [key.values[0] for key in sorted(keys)] == [3, 2, 1, None]
+    keys = [_SortKey([value], ["asc"]) for value in (1, None, 3, 2)]
+    assert [key.values[0] for key in sorted(keys)] == [1, 2, 3, None]
+
+
+def test_sort_key_compares_later_clauses_on_ties():
+    first = _SortKey([1, "b", 7], ["asc", "desc", "asc"])
+    second = _SortKey([1, "a", 2], ["asc", "desc", "asc"])
+    assert first < second
+    assert not second < first
+
+
+def test_unordered_slices_return_every_hit_once():
+    es = SlicedES(documents())
+    ids = export_ids(es, slices=4)
+    assert sorted(ids) == sorted(doc["id"] for doc in documents())
+    assert not es.open_pits
+
+
+@pytest.mark.parametrize("sort", ["rank:asc", "rank:desc",
+                                  "rank:desc,name:asc", "name:desc,rank"])
+def test_ordered_slices_keep_the_order_of_a_single_search(sort):
+    expected = export_ids(SlicedES(documents()), sort)
+    es = SlicedES(documents())
+    assert export_ids(es, sort, slices=3) == expected
+    assert not es.open_pits
+
+
+@pytest.mark.parametrize("sort, slices", [(None, 1), (None, 3),
+                                          ("rank:asc", 1), ("rank:asc", 3)])
+def test_exported_records_have_no_sort_values(sort, slices):
+    async def run():
+        pages = without_sort(export_pages(SlicedES(documents()), "index", {},
+                                          sort, slices, 3))
+        return [hit async for hits in pages for hit in hits]
+    hits = asyncio.run(run())
+    assert len(hits) == len(documents())
+    assert not any("sort" in hit for hit in hits)
+
+
+def test_ordered_slices_yield_full_batches():
+    async def page_sizes():
+        pages = export_pages(SlicedES(documents(20)), "index", {}, "rank:asc",
+                             slices=3, batch_size=6)
+        return [len(hits) async for hits in pages]
+    assert asyncio.run(page_sizes()) == [6, 6, 6, 2]
+
+
+@pytest.mark.parametrize("sort", [None, "rank:asc"])
+def test_failed_slice_closes_the_point_in_time(sort):
+    es = SlicedES(documents(), fail_slice=1)
+
+    async def run():
+        with pytest.raises(RuntimeError, match="slice failed"):
+            await collect(export_pages(es, "index", {}, sort, 3, 3))
+        # the other slices were cancelled
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(run())
+    assert not es.open_pits
+
+
+@pytest.mark.parametrize("sort", [None, "rank:asc"])
+def test_abandoned_export_stops_fetching(sort):
+    es = SlicedES(documents(200))
+
+    async def run():
+        pages = export_pages(es, "index", {}, sort, 2, 2)
+        await pages.__anext__()
+        await asyncio.sleep(0.01)
+        # every slice only fetches a few pages more than it has buffered,
+        # out of the 100 pages of the export
+        assert es.searches <= 2 * (export.SLICE_BUFFER_PAGES + 3)
+        await pages.aclose()
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    asyncio.run(run())
+    assert not es.open_pits
+
+
+def test_sliced_export_against_the_fake_cluster():
+    FakeConnection.cluster = FakeCluster(documents=50, latency=0)
+
+    async def run(slices, sort):
+        es = create_client(EXPORT, ["http://fake-es:9200"],
+                           connection_class=FakeConnection)
+        try:
+            return await collect(export_pages(es, "data_portal", {}, sort,
+                                              slices, 7))
+        finally:
+            await es.close()
+
+    expected = [f"id{number}" for number in range(50)]
+    assert sorted(asyncio.run(run(4, None)), key=lambda id_: int(id_[2:])) == expected
+    assert asyncio.run(run(4, "organism:asc")) == expected
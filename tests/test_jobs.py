@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from app.jobs import (ExportJobs, DONE, FAILED, QUEUED, RUNNING, parse_range,
+                      read_file_range)
+
+
+# above the largest pid Linux hands out
+DEAD_PID = 2 ** 22 + 1
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=10-", (10, 99)),
+    ("bytes=90-200", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-200", (0, 99)),
+    (" bytes = 5-5", (5, 5)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=100-", "bytes=10-5", "bytes=-", "bytes=0-1,5-6", "items=0-1",
+    "bytes=a-b",
+])
+def test_parse_range_rejects_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+def test_read_file_range(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(bytes(range(200)))
+    data_file = open(path, "rb")
+    assert b"".join(read_file_range(data_file, 10, 150)) == bytes(range(10, 151))
+    assert data_file.closed
+
+
+async def rows(*chunks, delay=0):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
+
+
+def test_identical_jobs_share_one_file(tmp_path):
+    async def run():
+        jobs = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        jobs.start()
+        job = jobs.submit("key", "index", "csv", lambda: rows(b"a,", b"b"))
+        assert jobs.submit("key", "index", "csv", None) is job
+        await jobs.queue.join()
+        await jobs.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == DONE
+    assert open(job.path, "rb").read() == b"a,b"
+
+
+def test_stopped_jobs_are_submitted_again(tmp_path):
+    async def run():
+        jobs = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        jobs.start()
+        running = jobs.submit("running", "index", "csv",
+                              lambda: rows(b"a", b"b", delay=10))
+        queued = jobs.submit("queued", "index", "csv", lambda: rows(b"c"))
+        await asyncio.sleep(0.01)
+        assert (running.status, queued.status) == (RUNNING, QUEUED)
+        await jobs.stop()
+        # no part file or job left behind that nobody works on
+        assert os.listdir(tmp_path) == [f"{running.id}.json"]
+
+        restarted = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        restarted.start()
+        assert restarted.get(running.id).status == FAILED
+        assert restarted.get(queued.id) is None
+        job = restarted.submit("running", "index", "csv", lambda: rows(b"d"))
+        await restarted.queue.join()
+        await restarted.stop()
+        return job
+
+    assert asyncio.run(run()).status == DONE
+
+
+def test_jobs_of_dead_processes_are_not_reused(tmp_path):
+    async def run():
+        jobs = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        job = jobs.submit("key", "index", "csv", lambda: rows(b"a"))
+        info = dict(job.info(), status=RUNNING, pid=DEAD_PID)
+        (tmp_path / f"{job.id}.json").write_text(json.dumps(info))
+        part = tmp_path / f"{job.id}.csv.{DEAD_PID}.part"
+        part.write_bytes(b"partial")
+
+        restarted = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        restarted.start()
+        assert not part.exists()
+        job = restarted.submit("key", "index", "csv", lambda: rows(b"b"))
+        await restarted.queue.join()
+        await restarted.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == DONE
+    assert open(job.path, "rb").read() == b"b"
+
+
+def test_eviction_counts_the_files_of_every_process(tmp_path):
+    async def run():
+        first = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        first.start()
+        first.submit("first", "index", "csv", lambda: rows(b"x" * 60))
+        await first.queue.join()
+        await first.stop()
+
+        second = ExportJobs(str(tmp_path), 1, 10, 100, 3600)
+        second.start()
+        job = second.submit("second", "index", "csv", lambda: rows(b"y" * 60))
+        await second.queue.join()
+        await second.stop()
+        return job
+
+    job = asyncio.run(run())
+    assert sorted(os.listdir(tmp_path)) == sorted([f"{job.id}.csv",
+                                                   f"{job.id}.json"])
+
+
+def test_invalidate_drops_the_files_of_the_index(tmp_path):
+    async def run():
+        jobs = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        jobs.start()
+        jobs.submit("a", "index", "csv", lambda: rows(b"a"))
+        kept = jobs.submit("b", "other", "csv", lambda: rows(b"b"))
+        await jobs.queue.join()
+        await jobs.stop()
+        ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600).invalidate("index")
+        return kept
+
+    kept = asyncio.run(run())
+    assert sorted(os.listdir(tmp_path)) == sorted([f"{kept.id}.csv",
+                                                   f"{kept.id}.json"])
+
+
+def test_jobs_evicted_by_another_process_are_gone(tmp_path):
+    async def run():
+        jobs = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+        jobs.start()
+        job = jobs.submit("key", "index", "csv", lambda: rows(b"a"))
+        await jobs.queue.join()
+        await jobs.stop()
+        assert jobs.get(job.id).status == DONE
+        # another worker process evicts the files of the index
+        ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600).invalidate("index")
+        assert jobs.get(job.id) is None
+        assert job.id not in jobs.jobs
+        return jobs.submit("key", "index", "csv", lambda: rows(b"b"))
+
+    assert asyncio.run(run()).status == QUEUED
+
+
+def test_download_of_an_evicted_file_is_not_found(tmp_path, monkeypatch):
+    import app.main
+    from fastapi.testclient import TestClient
+
+    jobs = ExportJobs(str(tmp_path), 1, 10, 10 ** 6, 3600)
+    monkeypatch.setattr(app.main, "export_jobs", jobs)
+
+    async def run():
+        jobs.start()
+        job = jobs.submit("key", "index", "csv", lambda: rows(b"a,b\n"))
+        await jobs.queue.join()
+        await jobs.stop()
+        return job
+
+    job = asyncio.run(run())
+    client = TestClient(app.main.app)
+    response = client.get(f"/api/export-jobs/{job.id}/download",
+                          headers={"Range": "bytes=2-"})
+    assert (response.status_code, response.content) == (206, b"b\n")
+    # the file goes while this process still has the job in memory
+    os.remove(job.path)
+    assert client.get(f"/api/export-jobs/{job.id}/download").status_code == 404
@@ -0,0 +1,52 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main
+from bench.fake_es import FakeCluster, install
+
+
+@pytest.fixture
+def client(monkeypatch):
+    cluster = FakeCluster(documents=25, latency=0)
+    install(cluster)
+    # every test starts without cached versions and responses
+    monkeypatch.setattr(app.main.index_versions, "versions", {})
+    app.main.aggregation_cache.invalidate()
+    return TestClient(app.main.app), cluster
+
+
+def test_matching_etag_is_answered_without_searching(client):
+    client, cluster = client
+    response = client.get("/api/data_portal?limit=5")
+    tag = response.headers["ETag"]
+    assert response.headers["Cache-Control"]
+    assert response.headers["Last-Modified"]
+
+    requests = cluster.requests
+    response = client.get("/api/data_portal?limit=5",
+                          headers={"If-None-Match": tag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == tag
+    assert cluster.requests == requests
+
+
+def test_etag_depends_on_the_page(client):
+    client, _ = client
+    tag = client.get("/api/data_portal?limit=5").headers["ETag"]
+    response = client.get("/api/data_portal?limit=5&offset=5",
+                          headers={"If-None-Match": tag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != tag
+
+
+def test_cursor_pages_have_no_etag(client):
+    client, _ = client
+    response = client.get("/api/data_portal?limit=5&cursor=*")
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    response = client.get(
+        f"/api/data_portal?limit=5&cursor={response.json()['next_cursor']}",
+        headers={"If-None-Match": "*"})
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
@@ -0,0 +1,155 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import pagination
+from app.pagination import (FIRST_CURSOR, InvalidCursor, OpenCursors,
+                            TooManyCursors, search_cursor_page)
+from bench.fake_es import FakeCluster, install
+
+
+class PitES:
+    # point in time searches over count documents; every search returns a
+    # new point in time id and only the latest one closes the point in time
+    def __init__(self, count, fail=False):
+        self.count = count
+        self.fail = fail
+        self.pits = 0
+        self.searches = 0
+        self.open_pits = dict()
+
+    async def open_point_in_time(self, index, keep_alive):
+        self.pits += 1
+        pit_id = f"pit{self.pits}"
+        self.open_pits[pit_id] = pit_id
+        return {"id": pit_id}
+
+    async def close_point_in_time(self, body):
+        root = body["id"].partition("~")[0]
+        if self.open_pits.get(root) == body["id"]:
+            del self.open_pits[root]
+
+    async def search(self, body, filter_path=None):
+        if self.fail:
+            raise RuntimeError("search failed")
+        self.searches += 1
+        root = body["pit"]["id"].partition("~")[0]
+        assert root in self.open_pits
+        self.open_pits[root] = f"{root}~{self.searches}"
+        start = body["search_after"][-1] + 1 if "search_after" in body else 0
+        hits = [{"_id": f"id{number}", "sort": [number]}
+                for number in range(start, min(start + body["size"], self.count))]
+        return {"pit_id": self.open_pits[root],
+                "hits": {"total": {"value": self.count}, "hits": hits}}
+
+
+def pages(es, body, size, open_cursors, sort=None):
+    # follows the cursors to the end, returns the ids of every page
+    async def run():
+        result = []
+        cursor = FIRST_CURSOR
+        while cursor is not None:
+            response, cursor = await search_cursor_page(
+                es, "data_portal", body, sort, size, cursor, open_cursors)
+            result.append([hit["_id"] for hit in response["hits"]["hits"]])
+        return result
+    return asyncio.run(run())
+
+
+def test_cursors_page_to_the_end_and_close_the_point_in_time():
+    es = PitES(7)
+    open_cursors = OpenCursors(10)
+    assert pages(es, {}, 3, open_cursors) == [
+        ["id0", "id1", "id2"], ["id3", "id4", "id5"], ["id6"]]
+    assert es.open_pits == {}
+    assert open_cursors.stats()["open"] == 0
+
+
+def test_empty_last_page_closes_the_point_in_time():
+    es = PitES(6)
+    open_cursors = OpenCursors(10)
+    assert pages(es, {}, 3, open_cursors)[-1] == []
+    assert es.open_pits == {}
+    assert open_cursors.stats()["open"] == 0
+
+
+def test_cursor_of_another_query_is_rejected():
+    es = PitES(10)
+    open_cursors = OpenCursors(10)
+
+    async def run():
+        _, cursor = await search_cursor_page(
+            es, "data_portal", {"query": {"term": {"a": 1}}}, None, 3,
+            FIRST_CURSOR, open_cursors)
+        for index, body, sort in (
+                ("data_portal", {"query": {"term": {"a": 2}}}, None),
+                ("data_portal", {"query": {"term": {"a": 1}}}, "organism"),
+                ("tracking_status", {"query": {"term": {"a": 1}}}, None)):
+            with pytest.raises(InvalidCursor):
+                await search_cursor_page(es, index, body, sort, 3, cursor,
+                                         open_cursors)
+        with pytest.raises(InvalidCursor):
+            await search_cursor_page(es, "data_portal", {}, None, 3,
+                                     "not a cursor", open_cursors)
+
+    asyncio.run(run())
+
+
+def test_open_cursors_are_limited(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(pagination, "time",
+                        SimpleNamespace(monotonic=lambda: now[0]))
+    es = PitES(10)
+    open_cursors = OpenCursors(2, keep_alive=60)
+
+    async def first_page():
+        return await search_cursor_page(es, "data_portal", {}, None, 3,
+                                        FIRST_CURSOR, open_cursors)
+
+    asyncio.run(first_page())
+    asyncio.run(first_page())
+    with pytest.raises(TooManyCursors):
+        asyncio.run(first_page())
+    # no point in time was opened for the refused cursor
+    assert es.pits == 2
+    # abandoned cursors no longer count once their point in time expired
+    now[0] += 61
+    asyncio.run(first_page())
+    assert open_cursors.stats() == {"open": 1, "limit": 2, "refused": 1}
+
+
+def test_failed_first_page_closes_the_point_in_time():
+    es = PitES(10, fail=True)
+    open_cursors = OpenCursors(10)
+    with pytest.raises(RuntimeError):
+        pages(es, {}, 3, open_cursors)
+    assert es.open_pits == {}
+    assert open_cursors.stats()["open"] == 0
+
+
+@pytest.fixture
+def client():
+    import app.main
+    cluster = FakeCluster(documents=25, latency=0)
+    install(cluster)
+    return TestClient(app.main.app), cluster
+
+
+def test_cursor_pages_need_a_limit(client):
+    client, cluster = client
+    response = client.get("/api/data_portal?cursor=*&limit=0")
+    assert response.status_code == 400
+    assert cluster.requests == 0
+
+
+def test_cursor_pages_through_the_api(client):
+    client, _ = client
+    ids = []
+    cursor = "*"
+    while cursor is not None:
+        data = client.get(f"/api/data_portal?cursor={cursor}&limit=10").json()
+        ids.extend(record["_id"] for record in data["results"])
+        cursor = data["next_cursor"]
+    assert ids == [f"id{number}" for number in range(25)]
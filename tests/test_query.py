@@ -0,0 +1,69 @@
+import pytest
+
+from app.query import NGRAM_SIZE, has_ngrams, search_clauses
+from app.search_index import NGRAM_ANALYZER, ngram_index_body
+
+
+@pytest.mark.parametrize("search, expected", [
+    ("a", False),
+    ("ab", False),
+    ("a b", False),
+    ("E c", False),
+    ("a_b_c", False),
+    ("x" * NGRAM_SIZE, True),
+    ("ab cde", True),
+    ("Homo sapiens", True),
+])
+def test_has_ngrams(search, expected):
+    assert has_ngrams(search) is expected
+
+
+@pytest.mark.parametrize("search", ["a b", "ab"])
+def test_short_words_are_searched_with_wildcards(search):
+    clauses = search_clauses("data_portal", search, ngram=True)
+    assert all(list(clause) == ["wildcard"] for clause in clauses)
+    assert clauses[0]["wildcard"]["organism"]["value"] == f"*{search}*"
+
+
+def test_long_words_are_searched_through_the_ngram_subfields():
+    clauses = search_clauses("data_portal", "ab cde", ngram=True)
+    assert clauses[0] == {"match": {"organism.ngram": {"query": "ab cde",
+                                                      "operator": "and"}}}
+    # .text subfields have their n-grams on their parent
+    assert "symbionts_records.organism.ngram" in clauses[2]["match"]
+
+
+def test_indexes_without_ngrams_use_wildcards():
+    clauses = search_clauses("data_portal", "sapiens")
+    assert all(list(clause) == ["wildcard"] for clause in clauses)
+
+
+def test_ngram_index_body_keeps_the_existing_mapping():
+    settings = {"number_of_shards": "2", "number_of_replicas": "1",
+                "uuid": "abc", "creation_date": "1",
+                "analysis": {"analyzer": {"other": {"type": "standard"}}}}
+    mapping = {"mappings": {"properties": {
+        "organism": {"type": "keyword"},
+        "commonName": {"type": "keyword", "fields": {"raw": {"type": "keyword"}}},
+        "symbionts_records": {"type": "nested", "properties": {
+            "organism": {"type": "keyword",
+                         "fields": {"text": {"type": "text"}}}}},
+        "tax_id": {"type": "keyword"},
+    }}}
+    body = ngram_index_body("data_portal", settings, mapping)
+
+    index_settings = body["settings"]["index"]
+    assert set(index_settings) == {"number_of_shards", "number_of_replicas",
+                                   "analysis"}
+    assert set(index_settings["analysis"]["analyzer"]) == {"other",
+                                                           NGRAM_ANALYZER}
+    properties = body["mappings"]["properties"]
+    assert properties["tax_id"] == {"type": "keyword"}
+    assert properties["organism"]["fields"]["ngram"]["analyzer"] == NGRAM_ANALYZER
+    assert set(properties["commonName"]["fields"]) == {"raw", "ngram"}
+    symbiont = properties["symbionts_records"]
+    assert symbiont["type"] == "nested"
+    assert set(symbiont["properties"]["organism"]["fields"]) == {"text", "ngram"}
+    # the source mapping is left as it was
+    assert "ngram" not in mapping["mappings"]["properties"]["organism"].get(
+        "fields", {})